@@ -0,0 +1,140 @@
+import gc
+import sys
+import json
+import math
+import time
+import argparse
+
+from zephyr_fs import MemoryFS
+from zephyr_env import generate_project
+from zephyr_driver_emul import (
+    add_driver, update_main_c, update_native_sim_overlay, update_root_cmakelists, update_root_prjconf,
+)
+
+APP = "app"
+OUTPUT = "../modules"
+PROBE = "probe_sensor_emul"  # the driver added to every synthesised project
+
+# One driver addition into a project that already has N drivers, as done by add_driver
+STEPS = {
+    "add_driver": lambda app: add_driver(PROBE, "i2c", "7f", output=OUTPUT, fs=app),
+    "update_root_cmakelists": lambda app: update_root_cmakelists(OUTPUT, PROBE, fs=app),
+    "update_root_prjconf": lambda app: update_root_prjconf(PROBE, fs=app),
+    "update_native_sim_overlay": lambda app: update_native_sim_overlay(PROBE, "7f", fs=app),
+    "update_main_c": lambda app: update_main_c(PROBE, fs=app),
+}
+
+
+def driver_name(i):
+    return f"bench{i:04d}_sensor_emul"
+
+def new_project(pad_lines=0):
+    fs = MemoryFS()
+    changes = generate_project("bench", None, None, APP, "native_sim", "native_sim", fs=fs)
+    if any(change.action == "error" for change in changes):
+        sys.exit("\n".join(str(change) for change in changes))
+    app = fs.at(APP)
+    if pad_lines:
+        # Hand-written code and nodes the generator has to scan past on every update
+        main_c = app.read("src/main.c")
+        filler = "".join(f"static int user_helper_{i}(int x) {{ return x + {i}; }}\n" for i in range(pad_lines))
+        app.write("src/main.c", filler + main_c)
+        nodes = "".join(f"\n&gpio0 {{\n    user_node_{i} {{ status = \"disabled\"; }};\n}};\n" for i in range(pad_lines // 4))
+        app.write("boards/native_sim.overlay", app.read("boards/native_sim.overlay") + nodes)
+    return fs
+
+def grow(fs, start, stop):
+    # Root file updates only: module trees do not depend on how many drivers there are
+    app = fs.at(APP)
+    for i in range(start, stop):
+        name = driver_name(i)
+        update_root_cmakelists(OUTPUT, name, fs=app)
+        update_root_prjconf(name, fs=app)
+        update_native_sim_overlay(name, f"{i:x}", fs=app)
+        update_main_c(name, fs=app, make_backup=False)
+
+def clone(fs):
+    copy = MemoryFS()
+    copy.files = dict(fs.files)
+    copy.dirs = set(fs.dirs)
+    return copy
+
+def time_step(fs, step, repeat):
+    # Best of repeat runs, each on its own copy of the project; no GC pauses inside the timing (as timeit)
+    best = math.inf
+    for _ in range(repeat):
+        app = clone(fs).at(APP)
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            changes = STEPS[step](app)
+            best = min(best, time.perf_counter() - start)
+        finally:
+            gc.enable()
+        errors = [str(change) for change in changes if change.action == "error"]
+        if errors:
+            sys.exit(f"{step}: " + "; ".join(errors))
+    return best
+
+def slope(sizes, times):
+    # log-log slope between the two largest sizes: 1.0 is linear, 2.0 quadratic
+    (n0, t0), (n1, t1) = list(zip(sizes, times))[-2:]
+    return math.log(max(t1, 1e-9) / max(t0, 1e-9)) / math.log(n1 / n0)
+
+def run(sizes, repeat=3, pad_lines=0, steps=tuple(STEPS)):
+    fs = new_project(pad_lines)
+    app = fs.at(APP)
+    rows, count = [], 0
+    for n in sizes:
+        grow(fs, count, n)
+        count = n
+        rows.append({
+            "drivers": n,
+            "main_c_kb": len(app.read("src/main.c")) / 1024,
+            "overlay_kb": len(app.read("boards/native_sim.overlay")) / 1024,
+            "seconds": {step: time_step(fs, step, repeat) for step in steps},
+        })
+    slopes = {step: slope(sizes, [row["seconds"][step] for row in rows]) for step in steps} if len(sizes) > 1 else {}
+    return {"sizes": list(sizes), "rows": rows, "slopes": slopes}
+
+def format_report(report, max_slope):
+    steps = list(report["rows"][0]["seconds"])
+    lines = [f"{'drivers':>7} {'main.c':>9} {'overlay':>9}  " + "  ".join(f"{step:>{max(len(step), 9)}}" for step in steps)]
+    for row in report["rows"]:
+        lines.append(f"{row['drivers']:>7} {row['main_c_kb']:>7.0f}KB {row['overlay_kb']:>7.0f}KB  " +
+                     "  ".join(f"{row['seconds'][step] * 1000:>{max(len(step), 9) - 2}.3f}ms" for step in steps))
+    if report["slopes"]:
+        lines += ["", f"Scaling (log-log slope over the two largest sizes, limit {max_slope}):"]
+        for step, value in report["slopes"].items():
+            lines.append(f"  {step:<26} {value:5.2f}  {'SUPERLINEAR' if value > max_slope else 'ok'}")
+    return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description="Time add-driver and the update_* functions on synthesised projects of growing size.")
+    parser.add_argument("-n", "--sizes", default="1,10,100,1000", help="Comma separated driver counts (default 1,10,100,1000)")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="Runs per measurement, the fastest is kept (default 3)")
+    parser.add_argument("-p", "--pad-lines", type=int, default=0, help="Extra hand-written lines in main.c (and a quarter as overlay nodes)")
+    parser.add_argument("-s", "--step", action="append", choices=list(STEPS), default=None, help="Only time this step (repeatable)")
+    parser.add_argument("--max-slope", type=float, default=1.25, help="Fail when a step scales worse than N^slope (default 1.25)")
+    parser.add_argument("-o", "--output", default=None, help="Also write the results as JSON to this file")
+
+    args = parser.parse_args()
+
+    sizes = sorted({int(n) for n in args.sizes.split(",")})
+    if sizes[0] < 1:
+        parser.error("sizes must be positive driver counts")
+
+    report = run(sizes, args.repeat, args.pad_lines, tuple(args.step or STEPS))
+    report["max_slope"] = args.max_slope
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    print(format_report(report, args.max_slope))
+
+    if any(value > args.max_slope for value in report["slopes"].values()):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,174 +1,395 @@
 import os
 import re
+import csv
+import sys
 import argparse
-import os
 import difflib
-from shutil import copyfile
+from array import array
 from textwrap import dedent
 
-
-def write_file(path, content=""):
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    with open(path, "w") as f:
-        f.write(content)
-    print(f"Created: {path}")
-
-def update_root_cmakelists(output_folder, module_name):
-    cmakelists_path = os.path.join('./', "CMakeLists.txt")
-    if not os.path.isfile(cmakelists_path):
-        print(f"Warning: {cmakelists_path} does not exist. Skipping update.")
-        return
+from zephyr_fs import Change, DiskFS
+
+
+def compatible_of(module_name):
+    # 'sensirion_sht3xd_emul' -> 'sensirion,sht3xd-emul': DT_DRV_COMPAT is this with ',' and '-' as '_'
+    vendor, _, rest = module_name.partition('_')
+    return f"{vendor},{rest.replace('_', '-')}" if rest else module_name
+
+def write_file(fs, path, content=""):
+    fs.write(path, content)
+    return Change(path, "created", f"Created: {path}")
+
+def append_line(fs, path, line):
+    # Shared files of an aggregated module: add our line once, keep the others
+    with fs.lock(path):
+        if not fs.isfile(path):
+            return write_file(fs, path, line)
+        content = fs.read(path)
+        if line in content.splitlines(True):
+            return Change(path, "unchanged", f"{line.strip()} already present in {path}")
+        if content and not content.endswith("\n"):
+            content += "\n"
+        fs.write(path, content + line)
+        return Change(path, "updated", f"Updated: {path} (added {line.strip()})")
+
+def update_root_cmakelists(output_folder, module_name, fs=None):
+    fs = fs or DiskFS()
+    cmakelists_path = "CMakeLists.txt"
+    if not fs.isfile(cmakelists_path):
+        return [Change(cmakelists_path, "warning", f"Warning: {cmakelists_path} does not exist. Skipping update.")]
 
     extra_path = f"${{CMAKE_SOURCE_DIR}}/{output_folder}/{module_name}"
-    with open(cmakelists_path, "r") as f:
-        lines = f.readlines()
-
-    # Track state
-    in_extra_block = False
-    block_start = None
-    block_end = None
-    already_included = False
-    cmake_min_line = None
-
-    for i, line in enumerate(lines):
-        stripped = line.strip()
-        if stripped.startswith("cmake_minimum_required"):
-            cmake_min_line = i
-
-        if stripped.startswith("set(ZEPHYR_EXTRA_MODULES"):
-            in_extra_block = True
-            block_start = i
-            if extra_path in line:
-                already_included = True
-        elif in_extra_block:
-            if extra_path in stripped:
-                already_included = True
-            if ")" in stripped:
-                block_end = i
-                in_extra_block = False
-
-    # If already present, no need to update
-    if already_included:
-        print(f"ZEPHYR_EXTRA_MODULES already includes '{extra_path}' — nothing to do.")
-        return
-
-    # Modify or insert
-    if block_start is not None and block_end is not None:
-        # Insert before closing parenthesis
-        lines.insert(block_end, f'\t"{extra_path}"\n')
-        print(f"Added {extra_path} to existing ZEPHYR_EXTRA_MODULES block.")
-    else:
-        # Insert new block after cmake_minimum_required
-        insert_idx = cmake_min_line + 1 if cmake_min_line is not None else 0
-        lines.insert(insert_idx, f'\nset(ZEPHYR_EXTRA_MODULES\n\t"{extra_path}"\n)\n')
-        print(f"Inserted new ZEPHYR_EXTRA_MODULES block with {extra_path}.")
+    with fs.lock(cmakelists_path):
+        lines = fs.read(cmakelists_path).splitlines(True)
+
+        # Track state
+        in_extra_block = False
+        block_start = None
+        block_end = None
+        already_included = False
+        cmake_min_line = None
+
+        for i, line in enumerate(lines):
+            stripped = line.strip()
+            if stripped.startswith("cmake_minimum_required"):
+                cmake_min_line = i
+
+            if stripped.startswith("set(ZEPHYR_EXTRA_MODULES"):
+                in_extra_block = True
+                block_start = i
+                if extra_path in line:
+                    already_included = True
+            elif in_extra_block:
+                if extra_path in stripped:
+                    already_included = True
+                if ")" in stripped:
+                    block_end = i
+                    in_extra_block = False
+
+        # If already present, no need to update
+        if already_included:
+            return [Change(cmakelists_path, "unchanged", f"ZEPHYR_EXTRA_MODULES already includes '{extra_path}' — nothing to do.")]
+
+        # Modify or insert
+        if block_start is not None and block_end is not None:
+            # Insert before closing parenthesis
+            lines.insert(block_end, f'\t"{extra_path}"\n')
+            message = f"Added {extra_path} to existing ZEPHYR_EXTRA_MODULES block."
+        else:
+            # Insert new block after cmake_minimum_required
+            insert_idx = cmake_min_line + 1 if cmake_min_line is not None else 0
+            lines.insert(insert_idx, f'\nset(ZEPHYR_EXTRA_MODULES\n\t"{extra_path}"\n)\n')
+            message = f"Inserted new ZEPHYR_EXTRA_MODULES block with {extra_path}."
 
-    with open(cmakelists_path, "w") as f:
-        f.writelines(lines)
+        fs.write(cmakelists_path, "".join(lines))
+        return [Change(cmakelists_path, "updated", message)]
 
-def update_root_prjconf(module_name):
-    kconfig_path = os.path.join('./', "prj.conf")
+def update_root_prjconf(module_name, fs=None, extra=()):
+    fs = fs or DiskFS()
+    kconfig_path = "prj.conf"
     config_name = f"CONFIG_{module_name.upper()}=y\n"
+    extra_lines = [f"CONFIG_{symbol}=y\n" for symbol in extra]  # subsystems the driver options need
+
+    with fs.lock(kconfig_path):
+        if not fs.isfile(kconfig_path):
+            fs.write(kconfig_path, "CONFIG_SENSOR=y\n" + config_name + "".join(extra_lines))  # minimal starter
+            return [Change(kconfig_path, "created", f"Warning: {kconfig_path} does not exist. Created and updated: {kconfig_path}")]
 
-    if not os.path.isfile(kconfig_path):
-        print(f"Warning: {kconfig_path} does not exist. Creating new one.")
-        with open(kconfig_path, "w") as f:
-            f.write(f"CONFIG_SENSOR=y\n")  # minimal starter
-            f.write(config_name)
-        print(f"Created and updated: {kconfig_path}")
-        return
-
-    with open(kconfig_path, "r") as f:
-        lines = f.readlines()
-
-    if any(config_name in line for line in lines):
-        print(f"{config_name} already present in {kconfig_path}")
-        return
-
-    new_lines = []
-    inserted = False
-    for i, line in enumerate(lines):
-        new_lines.append(line)
-        if not inserted and line.strip() == "CONFIG_SENSOR=y":
+        lines = fs.read(kconfig_path).splitlines(True)
+        missing = [line for line in extra_lines if line not in lines]
+
+        if any(config_name in line for line in lines) and not missing:
+            return [Change(kconfig_path, "unchanged", f"{config_name.strip()} already present in {kconfig_path}")]
+
+        new_lines = []
+        inserted = any(config_name in line for line in lines)
+        for i, line in enumerate(lines):
+            new_lines.append(line)
+            if not inserted and line.strip() == "CONFIG_SENSOR=y":
+                new_lines.append(config_name)
+                inserted = True
+
+        if not inserted:
+            # CONFIG_SENSOR=y not found, append at end
+            new_lines.append("\nCONFIG_SENSOR=y\n")
             new_lines.append(config_name)
-            inserted = True
 
-    if not inserted:
-        # CONFIG_SENSOR=y not found, append at end
-        new_lines.append("\nCONFIG_SENSOR=y\n")
-        new_lines.append(config_name)
+        if missing:
+            new_lines.append("\n")
+            new_lines.extend(missing)
 
-    with open(kconfig_path, "w") as f:
-        f.writelines(new_lines)
+        fs.write(kconfig_path, "".join(new_lines))
 
-    print(f"Updated: {kconfig_path} (added {config_name} after CONFIG_SENSOR=y)")
+        if not missing:
+            return [Change(kconfig_path, "updated", f"Updated: {kconfig_path} (added {config_name.strip()} after CONFIG_SENSOR=y)")]
+        added = ", ".join(line.strip() for line in ([config_name] if config_name not in lines else []) + missing)
+        return [Change(kconfig_path, "updated", f"Updated: {kconfig_path} (added {added})")]
 
-def update_native_sim_overlay(module_name, i2c_addr, interface="i2c0"):
-    overlay_path = os.path.join('./boards/native_sim.overlay')
+def update_native_sim_overlay(module_name, i2c_addr, interface="i2c0", fs=None, int_gpio=False):
+    fs = fs or DiskFS()
+    overlay_path = "boards/native_sim.overlay"
 
     # Prepare node label and compatible string
     node_parts = module_name.split('_')[:-1]
     node_label = '_'.join(node_parts)
-    compat = node_label.replace('_', ',') + "-emul"
-
-    new_node = f"""\
-    {node_label}: {node_label}@{i2c_addr} {{
-        compatible = "{compat}";
-        reg = <0x{i2c_addr}>;
-        status = "okay";
-        label = "{node_label}";
-    }};
-"""
-
-    # If overlay file does not exist, create it
-    if not os.path.isfile(overlay_path):
-        os.makedirs(os.path.dirname(overlay_path), exist_ok=True)
-        with open(overlay_path, "w") as f:
-            f.write(f"&{interface} {{\n    status = \"okay\";\n{new_node}}};\n")
-        print(f"Created and added node to: {overlay_path}")
-        return
-
-    with open(overlay_path, "r") as f:
-        lines = f.readlines()
-
-    if f"{node_label}@{i2c_addr}" in ''.join(lines):
-        print(f"Node '{node_label}@{i2c_addr}' already present in {overlay_path}")
-        return
-
-    new_lines = []
-    inside_iface = False
-    brace_level = 0
-    inserted = False
-
-    for line in lines:
-        stripped = line.strip()
-
-        if stripped.startswith(f"&{interface}"):
-            inside_iface = True
-
-        if inside_iface:
-            brace_level += line.count("{") - line.count("}")
-            if brace_level == 0 and not inserted:
-                # Right before the closing brace of &i2c0
-                new_lines.append(new_node)
-                inserted = True
-
-        new_lines.append(line)
-
-    # If interface block not found, append new full block
-    if not inserted:
-        print(f"Interface '&{interface}' not found. Appending new block at end.")
-        new_lines.append(f"\n&{interface} {{\n    status = \"okay\";\n{new_node}}};\n")
+    compat = compatible_of(module_name)
+
+    # Pin choice and insertion under one lock: concurrent add-drivers see each other's nodes
+    with fs.lock(overlay_path):
+        int_line = ""
+        if int_gpio:
+            # First free gpio0 pin; pin 0 drives led0 on native_sim
+            existing = fs.read(overlay_path) if fs.isfile(overlay_path) else ""
+            used = {0} | {int(p) for p in re.findall(r"<&gpio0\s+(\d+)", existing)}
+            pin = min(set(range(len(used) + 1)) - used)
+            int_line = f"        int-gpios = <&gpio0 {pin} 0>; /* GPIO_ACTIVE_HIGH */\n"
+
+        new_node = (
+            f"    {node_label}: {node_label}@{i2c_addr} {{\n"
+            f"        compatible = \"{compat}\";\n"
+            f"        reg = <0x{i2c_addr}>;\n"
+            f"{int_line}"
+            f"        status = \"okay\";\n"
+            f"        label = \"{node_label}\";\n"
+            f"    }};\n"
+        )
+
+        # If overlay file does not exist, create it
+        if not fs.isfile(overlay_path):
+            fs.write(overlay_path, f"&{interface} {{\n    status = \"okay\";\n{new_node}}};\n")
+            return [Change(overlay_path, "created", f"Created and added node to: {overlay_path}")]
+
+        lines = fs.read(overlay_path).splitlines(True)
+
+        if f"{node_label}@{i2c_addr}" in ''.join(lines):
+            return [Change(overlay_path, "unchanged", f"Node '{node_label}@{i2c_addr}' already present in {overlay_path}")]
+
+        changes = []
+        new_lines = []
+        inside_iface = False
+        brace_level = 0
+        inserted = False
+
+        for line in lines:
+            stripped = line.strip()
+
+            if stripped.startswith(f"&{interface}"):
+                inside_iface = True
+
+            if inside_iface:
+                brace_level += line.count("{") - line.count("}")
+                if brace_level == 0 and not inserted:
+                    # Right before the closing brace of &i2c0
+                    new_lines.append(new_node)
+                    inserted = True
+
+            new_lines.append(line)
+
+        # If interface block not found, append new full block
+        if not inserted:
+            changes.append(Change(overlay_path, "warning", f"Interface '&{interface}' not found. Appending new block at end."))
+            new_lines.append(f"\n&{interface} {{\n    status = \"okay\";\n{new_node}}};\n")
+
+        fs.write(overlay_path, "".join(new_lines))
+
+        changes.append(Change(overlay_path, "updated", f"Updated: {overlay_path} (added node '{node_label}@{i2c_addr}')"))
+        return changes
+
+def update_telemetry(fs=None, uart="uart1"):
+    # Shared binary telemetry sender: src/telemetry.[ch], CMake source and the UART node
+    fs = fs or DiskFS()
+    changes = []
+
+    header = dedent("""\
+        #ifndef TELEMETRY_H
+        #define TELEMETRY_H
+
+        #include <stdint.h>
+
+        // Frame layout (little endian, 14 bytes), decoded by scripts/zephyr_telemetry.py:
+        // sync 0xA5 0x5A | ts_us u32 | module u8 | instance u8 | channel u8 | value i32 (milli-units) | xor of bytes 2..12
+        #define TELEMETRY_SYNC0      0xA5
+        #define TELEMETRY_SYNC1      0x5A
+        #define TELEMETRY_FRAME_SIZE 14
+
+        void telemetry_send(uint8_t module, uint8_t instance, uint8_t channel, int32_t milli);
+
+        #endif
+    """)
+    source = dedent(f"""\
+        #include <zephyr/kernel.h>
+        #include <zephyr/device.h>
+        #include <zephyr/drivers/uart.h>
+        #include <zephyr/sys/byteorder.h>
+
+        #include "telemetry.h"
+
+        static const struct device *const telemetry_uart = DEVICE_DT_GET(DT_NODELABEL({uart}));
+
+        // One writer at a time so frames from different threads never interleave
+        K_MUTEX_DEFINE(telemetry_lock);
+
+        void telemetry_send(uint8_t module, uint8_t instance, uint8_t channel, int32_t milli)
+        {{
+            uint8_t frame[TELEMETRY_FRAME_SIZE] = {{ TELEMETRY_SYNC0, TELEMETRY_SYNC1 }};
+            uint8_t check = 0;
+
+            if (!device_is_ready(telemetry_uart)) {{
+                return;
+            }}
 
-    with open(overlay_path, "w") as f:
-        f.writelines(new_lines)
+            k_mutex_lock(&telemetry_lock, K_FOREVER);
+            // Timestamp taken under the lock so the stream stays monotonic
+            sys_put_le32(k_ticks_to_us_floor32(k_uptime_ticks()), &frame[2]);
+            frame[6] = module;
+            frame[7] = instance;
+            frame[8] = channel;
+            sys_put_le32((uint32_t)milli, &frame[9]);
+            for (size_t i = 2; i < TELEMETRY_FRAME_SIZE - 1; i++) {{
+                check ^= frame[i];
+            }}
+            frame[TELEMETRY_FRAME_SIZE - 1] = check;
 
-    print(f"Updated: {overlay_path} (added node '{node_label}@{i2c_addr}')")
+            for (size_t i = 0; i < TELEMETRY_FRAME_SIZE; i++) {{
+                uart_poll_out(telemetry_uart, frame[i]);
+            }}
+            k_mutex_unlock(&telemetry_lock);
+        }}
+    """)
+    for path, content in (("src/telemetry.h", header), ("src/telemetry.c", source)):
+        if fs.isfile(path):
+            changes.append(Change(path, "unchanged", f"{path} already present"))
+        else:
+            changes.append(write_file(fs, path, content))
+
+    cmakelists_path = "CMakeLists.txt"
+    sources_line = "target_sources(app PRIVATE src/telemetry.c)\n"
+    with fs.lock(cmakelists_path):
+        if not fs.isfile(cmakelists_path):
+            changes.append(Change(cmakelists_path, "warning", f"Warning: {cmakelists_path} does not exist. Add '{sources_line.strip()}' by hand."))
+        elif sources_line in fs.read(cmakelists_path).splitlines(True):
+            changes.append(Change(cmakelists_path, "unchanged", f"{sources_line.strip()} already present in {cmakelists_path}"))
+        else:
+            lines = fs.read(cmakelists_path).splitlines(True)
+            # Right after the main.c sources, or at the end
+            idx = next((i + 1 for i, l in enumerate(lines) if l.startswith("target_sources(app")), len(lines))
+            lines.insert(idx, sources_line)
+            fs.write(cmakelists_path, "".join(lines))
+            changes.append(Change(cmakelists_path, "updated", f"Updated: {cmakelists_path} (added src/telemetry.c)"))
+
+    overlay_path = "boards/native_sim.overlay"
+    with fs.lock(overlay_path):
+        if not fs.isfile(overlay_path):
+            changes.append(Change(overlay_path, "warning", f"Warning: {overlay_path} does not exist. Enable &{uart} by hand."))
+        elif re.search(rf"^&{uart}\s*{{", fs.read(overlay_path), re.M):
+            changes.append(Change(overlay_path, "unchanged", f"&{uart} already present in {overlay_path}"))
+        else:
+            content = fs.read(overlay_path)
+            if content and not content.endswith("\n"):
+                content += "\n"
+            # On native_sim every UART is a host pseudotty
+            fs.write(overlay_path, content + f"\n&{uart} {{\n    status = \"okay\";\n}};\n")
+            changes.append(Change(overlay_path, "updated", f"Updated: {overlay_path} (enabled &{uart} for telemetry)"))
+
+    return changes
+
+def parse_reduce(spec):
+    # 'decimate:N' (1 report every N samples), 'window:N' (mean/min/max of N samples)
+    # or 'deadband:D' (report when a channel moves more than D units from the last report)
+    kind, _, value = spec.partition(":")
+    try:
+        if kind in ("decimate", "window") and int(value) >= 2:
+            return kind, int(value)
+        if kind == "deadband" and float(value) > 0:
+            return kind, round(float(value) * 1000)  # compared in milli-units
+    except ValueError:
+        pass
+    raise ValueError(f"Invalid reduce stage '{spec}', expected 'decimate:N', 'window:N' or 'deadband:D' (N >= 2, D > 0).")
+
+def reduce_stage(name, kind, value, channels, report, telemetry=False):
+    # Per-instance state (goes after <name>_devs) and the block replacing the plain report
+    NAME = name.upper()
+    n = len(channels)
+    milli = ("int32_t milli[] = {\n"
+             + "".join(f"    (int32_t)sensor_value_to_milli(&val{c}),\n" for c in range(n))
+             + "};\n")
+
+    if kind == "decimate":
+        state = dedent(f"""
+            // {NAME} output stage: one report every {NAME}_DECIMATE samples
+            #define {NAME}_DECIMATE {value}
+            struct {name}_stage {{
+                uint32_t count;
+            }};
+        """)
+        block = (f"struct {name}_stage *st = &{name}_stages[i];\n\n"
+                 f"if (++st->count == {NAME}_DECIMATE) {{\n"
+                 f"    st->count = 0;\n"
+                 + "".join(f"    {l}\n" for l in report.splitlines())
+                 + "}\n")
+    elif kind == "window":
+        state = dedent(f"""
+            // {NAME} output stage: mean/min/max over {NAME}_WINDOW samples
+            #define {NAME}_WINDOW {value}
+            struct {name}_stage {{
+                int64_t sum[{n}];
+                int32_t min[{n}];
+                int32_t max[{n}];
+                uint32_t count;
+            }};
+        """)
+        if telemetry:
+            # A frame carries one value per channel: send the mean (the decoder reports min/max per stream)
+            out = "".join(f"telemetry_send({NAME}_TELEMETRY_ID, i, {ch}, (int32_t)(st->sum[{c}] / {NAME}_WINDOW));\n"
+                          for c, ch in enumerate(channels))
+        else:
+            fmt = " ".join("SENSOR_CHAN={mean %.3f min %.3f max %.3f}" for _ in channels)
+            args = "".join(f", st->sum[{c}] / ({NAME}_WINDOW * 1000.0), st->min[{c}] / 1000.0, st->max[{c}] / 1000.0"
+                           for c in range(n))
+            out = f"LOG_INF(\"%s: {fmt}\", dev->name{args});\n"
+        block = (milli
+                 + f"struct {name}_stage *st = &{name}_stages[i];\n\n"
+                 + "for (size_t c = 0; c < ARRAY_SIZE(milli); c++) {\n"
+                 + "    st->sum[c] += milli[c];\n"
+                 + "    st->min[c] = st->count ? MIN(st->min[c], milli[c]) : milli[c];\n"
+                 + "    st->max[c] = st->count ? MAX(st->max[c], milli[c]) : milli[c];\n"
+                 + "}\n"
+                 + f"if (++st->count == {NAME}_WINDOW) {{\n"
+                 + "".join(f"    {l}\n" for l in out.splitlines())
+                 + f"    *st = (struct {name}_stage){{ 0 }};\n"
+                 + "}\n")
+    else:
+        state = dedent(f"""
+            // {NAME} output stage: report only when a channel leaves the deadband around the last report
+            #define {NAME}_DEADBAND_MILLI {value}
+            struct {name}_stage {{
+                int32_t last[{n}];
+                bool valid;
+            }};
+        """)
+        block = (milli
+                 + f"struct {name}_stage *st = &{name}_stages[i];\n"
+                 + "bool changed = !st->valid;\n\n"
+                 + "for (size_t c = 0; c < ARRAY_SIZE(milli); c++) {\n"
+                 + "    int32_t delta = milli[c] - st->last[c];\n\n"
+                 + f"    changed |= delta > {NAME}_DEADBAND_MILLI || delta < -{NAME}_DEADBAND_MILLI;\n"
+                 + "}\n"
+                 + "if (changed) {\n"
+                 + "    for (size_t c = 0; c < ARRAY_SIZE(milli); c++) {\n"
+                 + "        st->last[c] = milli[c];\n"
+                 + "    }\n"
+                 + "    st->valid = true;\n"
+                 + "".join(f"    {l}\n" for l in report.splitlines())
+                 + "}\n")
+
+    state += f"static struct {name}_stage {name}_stages[ARRAY_SIZE({name}_devs)];\n"
+    return state, block
 
 def update_main_c(
     module_name: str,
-    path: str = "./src/main.c",
+    path: str = "src/main.c",
     *,
+    fs=None,
     api: str = "sensor",                 # 'sensor' | 'custom'
     channels: list[str] | None = None,   # e.g. ["SENSOR_CHAN_LIGHT"] or ["SENSOR_CHAN_AMBIENT_TEMP","SENSOR_CHAN_HUMIDITY"]
     interval_ms: int = 1000,
@@ -177,322 +398,1464 @@ def update_main_c(
     extra_includes: list[str] | None = None,
     make_backup: bool = True,
     show_diff: bool = False,
-) -> bool:
-    if not os.path.isfile(path):
-        print(f"Error: {path} does not exist.")
-        return False
+    trigger: bool = False,               # data-ready handler instead of a polling thread
+    pm: bool = False,                    # runtime PM get/put around each fetch
+    telemetry: bool = False,             # binary frames (src/telemetry.c) instead of LOG_INF
+    reduce: str | None = None,           # output stage between fetch and report, see parse_reduce
+) -> list[Change]:
+    fs = fs or DiskFS()
+    if not fs.isfile(path):
+        return [Change(path, "error", f"Error: {path} does not exist.")]
 
     name = module_name.strip()
     if not name or any(c.isspace() for c in name):
-        print("Error: module_name must be a single identifier, e.g. 'sensirion_sht3xd_emul'.")
-        return False
+        return [Change(path, "error", "Error: module_name must be a single identifier, e.g. 'sensirion_sht3xd_emul'.")]
+    if trigger and api != "sensor":
+        return [Change(path, "error", "Error: trigger mode needs the sensor API.")]
+    if telemetry and api != "sensor":
+        return [Change(path, "error", "Error: telemetry needs the sensor API.")]
+    if reduce and api != "sensor":
+        return [Change(path, "error", "Error: a reduce stage needs the sensor API.")]
+    try:
+        stage = parse_reduce(reduce) if reduce else None
+    except ValueError as e:
+        return [Change(path, "error", f"Error: {e}")]
 
     NAME = name.upper()
     channels = (channels or [])[:]
     extra_includes = extra_includes or []
 
-    with open(path, "r", encoding="utf-8") as f:
-        original_lines = f.readlines()
-    original_str = "".join(original_lines)
-
-    # ---------------------- includes ----------------------
-    need_includes = [
-        "#include <zephyr/kernel.h>\n",
-        "#include <zephyr/device.h>\n",
-        "#include <zephyr/devicetree.h>\n",
-        "#include <zephyr/logging/log.h>\n",
-    ]
-    if api == "sensor":
-        need_includes.append("#include <zephyr/drivers/sensor.h>\n")
-    for inc in extra_includes:
-        line = inc if inc.startswith("#include") else f"#include {inc}"
-        if not line.endswith("\n"):
-            line += "\n"
-        if line not in need_includes:
-            need_includes.append(line)
-
-    include_inserts = [l for l in need_includes if l not in original_str]
-
-    emul_insert = ""
-    if emul_header:
-        hdr_line = f"#include {emul_header}\n"
-        if hdr_line not in original_str:
-            emul_insert = "#ifdef CONFIG_EMUL\n" + hdr_line + "#endif\n"
-
-    # ---------------------- defines / device ----------------------
-    # Timing/prio go after LED_BLINK_INTERVAL_MS
-    prio_define    = f"#define {NAME}_PRIORITY    {int(priority)}\n"
-    timing_define  = f"#define {NAME}_INTERVAL_MS   {int(interval_ms)}\n"
-    timing_block = []
-    if prio_define not in original_str:
-        timing_block.append(prio_define)
-    if timing_define not in original_str:
-        timing_block.append(timing_define)
-
-    # Device defines go in the "Thread stack and control block" section BEFORE any stacks
-    comm_define = f"// {NAME} configuration\n\n"
-    node_define = f"#define {NAME}_NODE DT_NODELABEL({name[:-5]})\n"
-    dev_decl    = f"static const struct device *{name}_dev = DEVICE_DT_GET({NAME}_NODE);\n"
-    device_block = []
-    if comm_define not in original_str:
-        device_block.append(comm_define)
-    if node_define not in original_str:
-        device_block.append(node_define)
-    if dev_decl not in original_str:
-        device_block.append(dev_decl)
-    device_block_str = "".join(device_block)
-
-    # Thread defs for this module
-    stack_def = f"K_THREAD_STACK_DEFINE({name}_stack, STACK_SIZE);\n"
-    tcb_def   = f"static struct k_thread {name}_thread_data;\n"
-    thread_defs_block = []
-    if stack_def not in original_str:
-        thread_defs_block.append(stack_def)
-    if tcb_def not in original_str:
-        thread_defs_block.append(tcb_def)
-    thread_defs_str = "".join(thread_defs_block)
-
-    # ---------------------- thread function ----------------------
-    if api == "sensor":
-        if not channels:
-            channels = ["SENSOR_CHAN_LIGHT"]
-        decl_vars = ", ".join([f"val{i}" for i in range(len(channels))]) or "val0"
-        if decl_vars == "val0" and channels == []:
-            channels = ["SENSOR_CHAN_LIGHT"]
-
-        get_lines = []
-        fmt_parts, fmt_args = [], []
-        for i, ch in enumerate(channels):
-            get_lines.append(f"        && (sensor_channel_get({name}_dev, {ch}, &val{i}) == 0)")
-            #label = ch.replace("SENSOR_CHAN_", "")
-            label = "SENSOR_CHAN"
-            fmt_parts.append(f"{label}={{%.3f}}")
-            fmt_args.append(f"sensor_value_to_double(&val{i})")
-
-        thread_func = dedent(f"""
-            // {NAME} Thread
-
-            void {name}_thread(void *arg1, void *arg2, void *arg3)
-            {{
-                struct sensor_value {decl_vars};
-
-                while (1) {{
-                    if (sensor_sample_fetch({name}_dev) == 0
-            {chr(10).join(get_lines)}) {{
-                        LOG_INF("{name}: {' '.join(fmt_parts)}", {', '.join(fmt_args)});
+    with fs.lock(path):
+        original_str = fs.read(path)
+        original_lines = original_str.splitlines(True)
+
+        # ---------------------- includes ----------------------
+        need_includes = [
+            "#include <zephyr/kernel.h>\n",
+            "#include <zephyr/device.h>\n",
+            "#include <zephyr/devicetree.h>\n",
+            "#include <zephyr/logging/log.h>\n",
+        ]
+        if api == "sensor":
+            need_includes.append("#include <zephyr/drivers/sensor.h>\n")
+        if pm:
+            need_includes.append("#include <zephyr/pm/device_runtime.h>\n")
+        if telemetry:
+            need_includes.append("#include \"telemetry.h\"\n")
+        for inc in extra_includes:
+            line = inc if inc.startswith("#include") else f"#include {inc}"
+            if not line.endswith("\n"):
+                line += "\n"
+            if line not in need_includes:
+                need_includes.append(line)
+
+        include_inserts = [l for l in need_includes if l not in original_str]
+
+        # Named trace events marking fetch/log in the sampling loop (used by 'make profile')
+        if "#define TRACE_MARK(" not in original_str:
+            include_inserts.append(dedent("""
+                #ifdef CONFIG_TRACING_CTF
+                #include <zephyr/tracing/tracing.h>
+                #define TRACE_MARK(name, arg) sys_trace_named_event(name, arg, 0)
+                #else
+                #define TRACE_MARK(name, arg)
+                #endif
+            """).lstrip("\n"))
+
+        emul_insert = ""
+        if emul_header:
+            hdr_line = f"#include {emul_header}\n"
+            if hdr_line not in original_str:
+                emul_insert = "#ifdef CONFIG_EMUL\n" + hdr_line + "#endif\n"
+
+        # ---------------------- defines / device ----------------------
+        # Timing/prio go after LED_BLINK_INTERVAL_MS
+        prio_define    = f"#define {NAME}_PRIORITY    {int(priority)}\n"
+        timing_define  = f"#define {NAME}_INTERVAL_MS   {int(interval_ms)}\n"
+        # Per-thread stack size, starts at the shared default (see zephyr_stack_tune.py)
+        stack_define   = f"#define {NAME}_STACK_SIZE   STACK_SIZE\n"
+        timing_block = []
+        if not trigger:
+            if prio_define not in original_str:
+                timing_block.append(prio_define)
+            if timing_define not in original_str:
+                timing_block.append(timing_define)
+            if not re.search(rf"^#define {NAME}_STACK_SIZE\b", original_str, re.M):
+                timing_block.append(stack_define)
+
+        # Device defines go in the "Thread stack and control block" section BEFORE any stacks.
+        # Every okay instance of the compatible lands in one compile-time array.
+        comm_define = f"// {NAME} configuration\n\n"
+        node_define = f"#define {NAME}_DEVICE(node_id) DEVICE_DT_GET(node_id),\n"
+        dev_decl    = (f"static const struct device *const {name}_devs[] = {{\n"
+                       f"    DT_FOREACH_STATUS_OKAY({name}, {NAME}_DEVICE)\n"
+                       f"}};\n")
+        device_block = []
+        if comm_define not in original_str:
+            device_block.append(comm_define)
+        if node_define not in original_str:
+            device_block.append(node_define)
+        if dev_decl not in original_str:
+            device_block.append(dev_decl)
+        # Module byte of the telemetry frames; zephyr_telemetry.py reads the names back from these defines
+        ids = re.findall(r"^#define (\w+)_TELEMETRY_ID\s+(\d+)", original_str, re.M)
+        if telemetry and NAME not in [n for n, _ in ids]:
+            telemetry_id = max([int(i) for _, i in ids], default=-1) + 1
+            if telemetry_id > 255:
+                return [Change(path, "error", "Error: telemetry module ids are one byte, 256 drivers at most.")]
+            device_block.append(f"#define {NAME}_TELEMETRY_ID {telemetry_id}\n")
+        device_block_str = "".join(device_block)
+
+        # Thread defs for this module
+        stack_def = f"K_THREAD_STACK_DEFINE({name}_stack, {NAME}_STACK_SIZE);\n"
+        tcb_def   = f"static struct k_thread {name}_thread_data;\n"
+        thread_defs_block = []
+        if not trigger and f"K_THREAD_STACK_DEFINE({name}_stack," not in original_str:
+            thread_defs_block.append(stack_def)
+        if not trigger and tcb_def not in original_str:
+            thread_defs_block.append(tcb_def)
+        thread_defs_str = "".join(thread_defs_block)
+
+        # ---------------------- thread function ----------------------
+        def fill(text, blocks):
+            # Replace '@SLOT@' lines with blocks at the slot's indentation; empty blocks drop the line
+            return re.sub(r"^( *)(@[A-Z_]+@)\n",
+                          lambda m: "".join((m.group(1) + l if l else l) + "\n" for l in blocks[m.group(2)].splitlines()),
+                          text, flags=re.M)
+
+        def slots(on_fail):
+            # Runtime PM powers the device only around the fetch; samples go to LOG_INF or telemetry frames
+            return {
+                "@PM_GET@": f"if (pm_device_runtime_get(dev) < 0) {{\n    LOG_WRN(\"Failed to power up %s\", dev->name);\n    {on_fail};\n}}\n" if pm else "",
+                "@PM_PUT@": "pm_device_runtime_put(dev);\n" if pm else "",
+                "@REPORT@": report,
+                # Instance index for the frames and the stage state: the handler only gets the device
+                "@INDEX@": (f"uint8_t i = 0;\n\nwhile (i < ARRAY_SIZE({name}_devs) - 1 && {name}_devs[i] != dev) {{\n    i++;\n}}\n"
+                            if telemetry or stage else ""),
+            }
+
+        if api == "sensor":
+            if not channels:
+                channels = ["SENSOR_CHAN_LIGHT"]
+            decl_vars = ", ".join([f"val{i}" for i in range(len(channels))]) or "val0"
+            if decl_vars == "val0" and channels == []:
+                channels = ["SENSOR_CHAN_LIGHT"]
+
+            get_lines = []
+            fmt_parts, fmt_args = [], ["dev->name"]
+            for i, ch in enumerate(channels):
+                get_lines.append(f"            && (sensor_channel_get(dev, {ch}, &val{i}) == 0)")
+                #label = ch.replace("SENSOR_CHAN_", "")
+                label = "SENSOR_CHAN"
+                fmt_parts.append(f"{label}={{%.3f}}")
+                fmt_args.append(f"sensor_value_to_double(&val{i})")
+            report = f"LOG_INF(\"%s: {' '.join(fmt_parts)}\", {', '.join(fmt_args)});\n"
+            if telemetry:
+                report = "".join(f"telemetry_send({NAME}_TELEMETRY_ID, i, {ch}, (int32_t)sensor_value_to_milli(&val{i}));\n"
+                                 for i, ch in enumerate(channels))
+            if stage:
+                # Decimate / window / deadband between the fetch and the report; state sits next to the devices
+                state, report = reduce_stage(name, *stage, channels, report, telemetry)
+                if f"{name}_stages[" not in original_str and f"{name}_devs[i]" not in original_str:  # new driver only
+                    device_block_str += state
+
+            handler_func = dedent(f"""
+                // {NAME} data-ready handler (runs in the system workqueue)
+
+                static void {name}_trigger_handler(const struct device *dev, const struct sensor_trigger *trig)
+                {{
+                    struct sensor_value {decl_vars};
+                    @INDEX@
+
+                    ARG_UNUSED(trig);
+                    TRACE_MARK("fetch", (uint32_t)(uintptr_t)dev);
+                    @PM_GET@
+                    if (sensor_sample_fetch(dev) == 0
+                @GET_LINES@) {{
+                        @REPORT@
+                        TRACE_MARK("logged", (uint32_t)(uintptr_t)dev);
                     }} else {{
-                        LOG_WRN("Failed to fetch {name} sample");
+                        LOG_WRN("Failed to fetch %s sample", dev->name);
+                    }}
+                    @PM_PUT@
+                }}
+            """).lstrip("\n").replace("@GET_LINES@", "\n".join(l[4:] for l in get_lines))
+            handler_func = fill(handler_func, slots("return"))
+
+            thread_func = dedent(f"""
+                // {NAME} Thread
+
+                void {name}_thread(void *arg1, void *arg2, void *arg3)
+                {{
+                    struct sensor_value {decl_vars};
+
+                    while (1) {{
+                        for (size_t i = 0; i < ARRAY_SIZE({name}_devs); i++) {{
+                            const struct device *dev = {name}_devs[i];
+
+                            TRACE_MARK("fetch", i);
+                            @PM_GET@
+                            if (sensor_sample_fetch(dev) == 0
+                @GET_LINES@) {{
+                                @REPORT@
+                                TRACE_MARK("logged", i);
+                            }} else {{
+                                LOG_WRN("Failed to fetch %s sample", dev->name);
+                            }}
+                            @PM_PUT@
+                        }}
+                        k_msleep({NAME}_INTERVAL_MS);
+                    }}
+                }}
+            """).lstrip("\n").replace("@GET_LINES@", "\n".join("    " + l for l in get_lines))
+            thread_func = fill(thread_func, slots("continue"))
+        else:
+            thread_func = dedent(f"""
+                // {NAME} Thread
+
+                void {name}_thread(void *arg1, void *arg2, void *arg3)
+                {{
+                    while (1) {{
+                        for (size_t i = 0; i < ARRAY_SIZE({name}_devs); i++) {{
+                            // TODO: implement '{name}' work on {name}_devs[i] here
+                        }}
+                        k_msleep({NAME}_INTERVAL_MS);
                     }}
-                    k_msleep({NAME}_INTERVAL_MS);
+                }}
+            """).lstrip("\n")
+
+        # ---------------------- main() injections (by anchors) ----------------------
+        # We will:
+        # - insert device readiness BEFORE the "LOG_INF(\"LED ready. Launching thread...\")" line
+        # - insert driver thread start AFTER the LED thread creation line
+        ready_block = dedent(f"""
+            /* --- {name} device readiness --- */
+            for (size_t i = 0; i < ARRAY_SIZE({name}_devs); i++) {{
+                if (!device_is_ready({name}_devs[i])) {{
+                    LOG_ERR("%s not ready", {name}_devs[i]->name);
+                    return 0;
                 }}
             }}
-        """).lstrip("\n")
-    else:
-        thread_func = dedent(f"""
-            // {NAME} Thread
-
-            void {name}_thread(void *arg1, void *arg2, void *arg3)
-            {{
-                while (1) {{
-                    // TODO: implement '{name}' work here
-                    k_msleep({NAME}_INTERVAL_MS);
+        """).rstrip()
+
+        trigger_block = dedent(f"""
+            /* --- {name} Trigger --- */
+            static const struct sensor_trigger {name}_trig = {{
+                .type = SENSOR_TRIG_DATA_READY,
+                .chan = SENSOR_CHAN_ALL,
+            }};
+            for (size_t i = 0; i < ARRAY_SIZE({name}_devs); i++) {{
+                if (sensor_trigger_set({name}_devs[i], &{name}_trig, {name}_trigger_handler) < 0) {{
+                    LOG_ERR("Failed to set %s data-ready trigger", {name}_devs[i]->name);
                 }}
             }}
-        """).lstrip("\n")
-
-    # ---------------------- main() injections (by anchors) ----------------------
-    # We will:
-    # - insert device readiness BEFORE the "LOG_INF(\"LED ready. Launching thread...\")" line
-    # - insert driver thread start AFTER the LED thread creation line
-    ready_block = dedent(f"""
-        /* --- {name} device readiness --- */
-        if (!device_is_ready({name}_dev)) {{
-            LOG_ERR("{name} not ready");
-            return 0;
-        }}
-    """).rstrip()
-
-    start_block = dedent(f"""
-        /* --- {name} Thread --- */
-        k_thread_create(&{name}_thread_data, {name}_stack, STACK_SIZE,
-                        {name}_thread, NULL, NULL, NULL,
-                        {NAME}_PRIORITY, 0, K_NO_WAIT);
-    """).rstrip()
-
-    LED_READY_RE   = re.compile(r'LOG_INF\("LED ready\. Launching thread', re.IGNORECASE)
-    LED_CREATE_RE  = re.compile(r'k_thread_create\(&\s*led_thread_data\b')
-
-    # ---------------------- build updated file ----------------------
-    updated = []
-    added_headers = False
-    inserted_timing = False
-    inserted_device_section = False
-    inserted_thread_defs = False
-    inserted_thread_func = False
-    injected_ready_before_ledready = False
-    injected_start_after_ledcreate = False
-
-    THREAD_SECTION_HDR_RE = re.compile(r"Thread stack and control block", re.IGNORECASE)
-    STACK_DEFINE_RE       = re.compile(r"^\s*K_THREAD_STACK_DEFINE\(", re.M)
-
-    flag_main = False
-
-    i = 0
-    while i < len(original_lines):
-        line = original_lines[i]
-        stripped = line.strip()
+        """).rstrip()
+
+        start_block = dedent(f"""
+            /* --- {name} Thread --- */
+            k_thread_create(&{name}_thread_data, {name}_stack, {NAME}_STACK_SIZE,
+                            {name}_thread, NULL, NULL, NULL,
+                            {NAME}_PRIORITY, 0, K_NO_WAIT);
+            k_thread_name_set(&{name}_thread_data, "{name}_thread");
+        """).rstrip()
+
+        # Marker comments identify blocks injected by a previous run
+        ready_marker = f"/* --- {name} device readiness --- */"
+        start_marker = f"/* --- {name} Thread --- */"
+        func_sig = f"void {name}_thread("
+        if trigger:
+            thread_func, start_block = handler_func, trigger_block
+            start_marker = f"/* --- {name} Trigger --- */"
+            func_sig = f"void {name}_trigger_handler("
+
+        LED_READY_RE   = re.compile(r'LOG_INF\("LED ready\. Launching thread', re.IGNORECASE)
+        LED_CREATE_RE  = re.compile(r'k_thread_create\(&\s*led_thread_data\b')
+
+        # ---------------------- build updated file ----------------------
+        updated = []
+        added_headers = False
+        inserted_timing = False
+        inserted_device_section = False
+        inserted_thread_defs = False
+        inserted_thread_func = False
+        injected_ready_before_ledready = False
+        injected_start_after_ledcreate = False
+
+        THREAD_SECTION_HDR_RE = re.compile(r"Thread stack and control block", re.IGNORECASE)
+        STACK_DEFINE_RE       = re.compile(r"^\s*K_THREAD_STACK_DEFINE\(", re.M)
+
+        flag_main = False
+
+        i = 0
+        while i < len(original_lines):
+            line = original_lines[i]
+            stripped = line.strip()
         
-        if "int main" in line:
-            flag_main = True
-        # 1) includes: add after kernel.h
-        if not added_headers and stripped == "#include <zephyr/kernel.h>":
-            updated.append(line)
-            if include_inserts:
-                updated.extend(include_inserts)
-            if emul_insert:
-                updated.append(emul_insert if emul_insert.endswith("\n") else emul_insert + "\n")
-            added_headers = True
-            i += 1
-            continue
+            if "int main" in line:
+                flag_main = True
+            # 1) includes: add after kernel.h
+            if not added_headers and stripped == "#include <zephyr/kernel.h>":
+                updated.append(line)
+                if include_inserts:
+                    updated.extend(include_inserts)
+                if emul_insert:
+                    updated.append(emul_insert if emul_insert.endswith("\n") else emul_insert + "\n")
+                added_headers = True
+                i += 1
+                continue
+
+            # 2) timing/prio after LED_BLINK_INTERVAL_MS
+            if not inserted_timing and stripped.startswith("#define LED_BLINK_INTERVAL_MS"):
+                updated.append(line)
+                if timing_block:
+                    updated.append("".join(timing_block))
+                inserted_timing = True
+                i += 1
+                continue
+
+            # 3) device block at start of "Thread stack and control block" section
+            if not inserted_device_section and THREAD_SECTION_HDR_RE.search(line):
+                if device_block_str:
+                    updated.append(device_block_str)
+                    updated.append('\n')
+                inserted_device_section = True
+                updated.append(line)
+                i += 1
+                continue
+
+            # 4) place our stack/tcb next to first K_THREAD_STACK_DEFINE
+            if not inserted_thread_defs and STACK_DEFINE_RE.match(stripped):
+                updated.append(line)
+                if thread_defs_str:
+                    updated.append(thread_defs_str)
+                inserted_thread_defs = True
+                i += 1
+                continue
+
+            # 5) inject our thread function immediately BEFORE 'int main(void)'
+            if not inserted_thread_func and stripped.startswith("// Main"):
+                if func_sig not in original_str:
+                    updated.append(thread_func)
+                    updated.append('\n')
+                inserted_thread_func = True
+                # fall-through
+
+            # 6) device readiness BEFORE "LED ready. Launching thread..."
+            if (not injected_ready_before_ledready) and LED_READY_RE.search(line):
+                if ready_marker not in original_str:
+                    updated.append("    " + ready_block.replace("\n", "\n    ") + "\n")
+                injected_ready_before_ledready = True
+
+            # 7) Driver thread create: inject right BEFORE "return 0;"
+            if (not injected_start_after_ledcreate) and flag_main and line[0] == "return 0;": #stripped.startswith("K_NO_WAIT"):
+                if start_marker not in original_str:
+                    updated.append("\n")  # add a blank line for readability
+                    updated.append("    " + start_block.replace("\n", "\n    ") + "\n")
+                injected_start_after_ledcreate = True
 
-        # 2) timing/prio after LED_BLINK_INTERVAL_MS
-        if not inserted_timing and stripped.startswith("#define LED_BLINK_INTERVAL_MS"):
-            updated.append(line)
-            if timing_block:
-                updated.append("".join(timing_block))
-            inserted_timing = True
-            i += 1
-            continue
-
-        # 3) device block at start of "Thread stack and control block" section
-        if not inserted_device_section and THREAD_SECTION_HDR_RE.search(line):
-            if device_block_str:
-                updated.append(device_block_str)
-            inserted_device_section = True
-            updated.append('\n')
             updated.append(line)
-            i += 1
-            continue
 
-        # 4) place our stack/tcb next to first K_THREAD_STACK_DEFINE
-        if not inserted_thread_defs and STACK_DEFINE_RE.match(stripped):
-            updated.append(line)
-            if thread_defs_str:
-                updated.append(thread_defs_str)
-            inserted_thread_defs = True
             i += 1
-            continue
-
-        # 5) inject our thread function immediately BEFORE 'int main(void)'
-        if not inserted_thread_func and stripped.startswith("// Main"):
-            if f"void {name}_thread(" not in original_str:
-                updated.append(thread_func)
-                updated.append('\n')
-            inserted_thread_func = True
-            # fall-through
-
-        # 6) device readiness BEFORE "LED ready. Launching thread..."
-        if (not injected_ready_before_ledready) and LED_READY_RE.search(line):
-            if ready_block not in original_str:
-                updated.append("    " + ready_block.replace("\n", "\n    ") + "\n")
-            injected_ready_before_ledready = True
-
-        # 7) Driver thread create: inject right BEFORE "return 0;"
-        if (not injected_start_after_ledcreate) and flag_main and line[0] == "return 0;": #stripped.startswith("K_NO_WAIT"):
-            if start_block not in original_str:
-                updated.append("\n")  # add a blank line for readability
-                updated.append("    " + start_block.replace("\n", "\n    ") + "\n")
-            injected_start_after_ledcreate = True
-
-        updated.append(line)
-
-        i += 1
-
-    merged = "".join(updated)
-
-    # ---------------------- fallbacks ----------------------
-    # headers
-    if not added_headers and (include_inserts or emul_insert):
-        header_blob = "".join(include_inserts) + (emul_insert if emul_insert else "")
-        merged = header_blob + original_str
-
-    # timing/prio
-    if not inserted_timing and timing_block:
-        merged += ("\n" if not merged.endswith("\n") else "") + "".join(timing_block)
-
-    # device block before '// Thread...' header; fallback: before first stack define; else append
-    if not inserted_device_section and device_block_str:
-        THREAD_COMMENT_RE = re.compile(r'^\s*//\s*Thread', re.M)
-        m = THREAD_COMMENT_RE.search(merged)
-        if m:
-            idx = m.start()
-            merged = merged[:idx] + device_block_str + merged[idx:]
-        else:
-            m2 = STACK_DEFINE_RE.search(merged)
-            if m2:
-                idx = m2.start()
+
+        merged = "".join(updated)
+
+        # ---------------------- fallbacks ----------------------
+        # headers
+        if not added_headers and (include_inserts or emul_insert):
+            header_blob = "".join(include_inserts) + (emul_insert if emul_insert else "")
+            merged = header_blob + original_str
+
+        # timing/prio
+        if not inserted_timing and timing_block:
+            merged += ("\n" if not merged.endswith("\n") else "") + "".join(timing_block)
+
+        # device block before '// Thread...' header; fallback: before first stack define; else append
+        if not inserted_device_section and device_block_str:
+            THREAD_COMMENT_RE = re.compile(r'^\s*//\s*Thread', re.M)
+            m = THREAD_COMMENT_RE.search(merged)
+            if m:
+                idx = m.start()
                 merged = merged[:idx] + device_block_str + merged[idx:]
             else:
-                merged += ("\n" if not merged.endswith("\n") else "") + device_block_str
-
-    # thread defs
-    if not inserted_thread_defs and thread_defs_str:
-        merged += ("\n" if not merged.endswith("\n") else "") + thread_defs_str
-
-    # thread func
-    if not inserted_thread_func and f"void {name}_thread(" not in merged:
-        merged += ("\n" if not merged.endswith("\n") else "") + thread_func
-
-    # readiness: if anchor missing, inject near start of main (after '{')
-    if not injected_ready_before_ledready and ready_block not in merged:
-        # try to inject after opening brace of main
-        main_sig = merged.find("int main(void)")
-        if main_sig != -1:
-            brace_pos = merged.find("{", main_sig)
-            if brace_pos != -1:
-                brace_pos += 1
-                merged = merged[:brace_pos] + "\n    " + ready_block.replace("\n", "\n    ") + "\n" + merged[brace_pos:]
+                m2 = STACK_DEFINE_RE.search(merged)
+                if m2:
+                    idx = m2.start()
+                    merged = merged[:idx] + device_block_str + merged[idx:]
+                else:
+                    merged += ("\n" if not merged.endswith("\n") else "") + device_block_str
+
+        # thread defs
+        if not inserted_thread_defs and thread_defs_str:
+            merged += ("\n" if not merged.endswith("\n") else "") + thread_defs_str
+
+        # thread func
+        if not inserted_thread_func and func_sig not in merged:
+            merged += ("\n" if not merged.endswith("\n") else "") + thread_func
+
+        # readiness: if anchor missing, inject near start of main (after '{')
+        if not injected_ready_before_ledready and ready_marker not in merged:
+            # try to inject after opening brace of main
+            main_sig = merged.find("int main(void)")
+            if main_sig != -1:
+                brace_pos = merged.find("{", main_sig)
+                if brace_pos != -1:
+                    brace_pos += 1
+                    merged = merged[:brace_pos] + "\n    " + ready_block.replace("\n", "\n    ") + "\n" + merged[brace_pos:]
+                else:
+                    merged += "\n/* main() brace not found; appending readiness */\n" + ready_block + "\n"
             else:
-                merged += "\n/* main() brace not found; appending readiness */\n" + ready_block + "\n"
-        else:
-            merged += "\n/* main() not found; appending readiness */\n" + ready_block + "\n"
-
-    # start thread: if LED create not found, append near end of main before return 0;
-    if not injected_start_after_ledcreate and start_block not in merged:
-        # place before final 'return 0;' inside main if possible
-        main_start = merged.find("int main(void)")
-        if main_start != -1:
-            ret_pos = merged.rfind("return 0;", main_start)
-            if ret_pos != -1:
-                merged = merged[:ret_pos] + "    " + start_block.replace("\n", "\n    ") + "\n    " + merged[ret_pos:]
+                merged += "\n/* main() not found; appending readiness */\n" + ready_block + "\n"
+
+        # start thread: if LED create not found, append near end of main before return 0;
+        if not injected_start_after_ledcreate and start_marker not in merged:
+            # place before final 'return 0;' inside main if possible
+            main_start = merged.find("int main(void)")
+            if main_start != -1:
+                ret_pos = merged.rfind("return 0;", main_start)
+                if ret_pos != -1:
+                    merged = merged[:ret_pos] + "    " + start_block.replace("\n", "\n    ") + "\n    " + merged[ret_pos:]
+                else:
+                    merged += "\n/* LED thread create anchor not found; appending driver start */\n" + start_block + "\n"
             else:
-                merged += "\n/* LED thread create anchor not found; appending driver start */\n" + start_block + "\n"
-        else:
-            merged += "\n/* main() not found; appending driver start */\n" + start_block + "\n"
+                merged += "\n/* main() not found; appending driver start */\n" + start_block + "\n"
+
+        # ---------------------- write ----------------------
+        if merged == original_str:
+            return [Change(path, "unchanged", f"No changes needed for '{name}'.")]
+
+        changes = []
+        if make_backup:
+            fs.write(path + ".bak", original_str)
+            changes.append(Change(path + ".bak", "created", f"Backup created: {path}.bak"))
+
+        fs.write(path, merged)
+
+        diff = ""
+        if show_diff:
+            diff = "\n".join(difflib.unified_diff(
+                original_lines, merged.splitlines(True),
+                fromfile=path + " (old)", tofile=path + " (new)", lineterm=""
+            ))
+
+        changes.append(Change(path, "updated", f"Updated: {path} (added handler for '{name}')", diff))
+        return changes
+
+# Optional features contribute C/CMake/Kconfig snippets to fixed slots of the
+# driver template, plus extra files to write next to the driver sources.
+PART_KEYS = (
+    "includes", "data_fields", "cfg_fields", "cfg_init", "convert", "helpers",
+    "fetch_pre", "fetch", "fetch_post", "transfer", "init", "api",
+    "device_pre", "device_init", "device_pm", "cmake", "kconfig", "binding",
+)
+
+def merge_parts(*parts):
+    merged = {key: "" for key in PART_KEYS}
+    merged["files"] = {}
+    for part in parts:
+        for key, value in part.items():
+            if key == "files":
+                merged["files"].update(value)
+            elif key == "includes":
+                merged[key] += "".join(l for l in value.splitlines(True) if l not in merged[key])
+            else:
+                merged[key] += value
+    return merged
+
+def load_trace(path, column=0):
+    # Binary captures are raw little-endian uint16 samples, anything else is CSV
+    samples = array("H")
+    if os.path.splitext(path)[1].lower() in (".bin", ".raw"):
+        with open(path, "rb") as f:
+            data = f.read()
+        samples.frombytes(data[:len(data) & ~1])
+        if sys.byteorder == "big":
+            samples.byteswap()
+        return samples
+
+    with open(path, newline="") as f:
+        for row in csv.reader(f):
+            if len(row) <= column:
+                continue
+            cell = row[column].strip()
+            try:
+                value = int(cell, 0)
+            except ValueError:
+                try:
+                    value = round(float(cell))
+                except (ValueError, OverflowError):
+                    continue  # header or comment line, nan / inf
+            samples.append(min(max(value, 0), 0xFFFF))
+    return samples
+
+def trace_parts(module_name, samples, source, inline_max=4096):
+    NAME = module_name.upper()
+    parts = {
+        "data_fields": "    uint32_t trace_pos;          // indice nella traccia registrata\n",
+        "fetch": f"""\
+    if ({module_name}_trace_len > 0) {{
+        uint16_t raw = {NAME}_TRACE_SAMPLE(data->trace_pos);
+
+        data->trace_pos = (data->trace_pos + 1) % {module_name}_trace_len;
+        return raw;
+    }}
+
+""",
+    }
+
+    if len(samples) <= inline_max:
+        # Small traces: compiled into the image as a const array
+        rows = []
+        for i in range(0, len(samples), 12):
+            rows.append("    " + ", ".join(f"0x{v:04X}" for v in samples[i:i + 12]) + ",")
+        parts["files"] = {f"{module_name}_trace.h": f"""\
+/*
+ * {module_name}_trace.h
+ * Generato da {os.path.basename(source)} ({len(samples)} campioni)
+ */
+
+#ifndef {NAME}_TRACE_H_
+#define {NAME}_TRACE_H_
+
+#include <stdint.h>
 
-    # ---------------------- write ----------------------
-    if merged == original_str:
-        print(f"No changes needed for '{name}'.")
-        return True
+static const uint16_t {module_name}_trace_data[] = {{
+{chr(10).join(rows)}
+}};
 
-    if make_backup:
-        copyfile(path, path + ".bak")
-        print(f"Backup created: {path}.bak")
+#endif  // {NAME}_TRACE_H_
+"""}
+        parts["includes"] = f'#include "{module_name}_trace.h"\n'
+        parts["helpers"] = f"""\
+// -----------------------------------------------------------------------------
+// Replay della traccia registrata (array const nell'immagine)
 
-    with open(path, "w", encoding="utf-8") as f:
-        f.write(merged)
+static const uint16_t *{module_name}_trace = {module_name}_trace_data;
+static const size_t {module_name}_trace_len = ARRAY_SIZE({module_name}_trace_data);
 
-    if show_diff:
-        print("\n".join(difflib.unified_diff(
-            original_lines, merged.splitlines(True),
-            fromfile=path + " (old)", tofile=path + " (new)", lineterm=""
-        )))
+#define {NAME}_TRACE_SAMPLE(i) ({module_name}_trace[i])
 
-    print(f"Updated: {path} (added handler for '{name}')")
-    return True
+"""
+        return parts
+
+    # Large traces: streamed from a host file that native_sim maps in memory
+    little_endian = array("H", samples)
+    if sys.byteorder == "big":
+        little_endian.byteswap()
+    parts["files"] = {
+        f"{module_name}_trace.bin": little_endian.tobytes(),
+        f"{module_name}_host.c": f"""\
+/*
+ * {module_name}_host.c
+ * Lato host (native_sim): compilato con la libc del PC, non con quella di Zephyr
+ */
+
+#include <fcntl.h>
+#include <stddef.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
+
+// Mappa in sola lettura un file del PC: le pagine vengono caricate solo quando servono
+const void *{module_name}_host_map(const char *path, size_t *len)
+{{
+    struct stat st;
+    void *addr;
+    int fd = open(path, O_RDONLY);
+
+    if (fd < 0) {{
+        return NULL;
+    }}
+    if (fstat(fd, &st) < 0 || st.st_size == 0) {{
+        close(fd);
+        return NULL;
+    }}
+    addr = mmap(NULL, st.st_size, PROT_READ, MAP_PRIVATE, fd, 0);
+    close(fd);
+    if (addr == MAP_FAILED) {{
+        return NULL;
+    }}
+    *len = st.st_size;
+    return addr;
+}}
+""",
+    }
+    parts["includes"] = "#include <zephyr/sys/byteorder.h>\n"
+    parts["helpers"] = f"""\
+// -----------------------------------------------------------------------------
+// Replay della traccia registrata (file del PC mappato in memoria, solo native_sim)
+
+#ifdef CONFIG_NATIVE_LIBRARY
+extern const void *{module_name}_host_map(const char *path, size_t *len);
+#endif
+
+static const uint16_t *{module_name}_trace;
+static size_t {module_name}_trace_len;
+
+#define {NAME}_TRACE_SAMPLE(i) sys_le16_to_cpu({module_name}_trace[i])
+
+"""
+    parts["init"] = f"""\
+#ifdef CONFIG_NATIVE_LIBRARY
+    if ({module_name}_trace == NULL) {{
+        size_t len = 0;
+
+        {module_name}_trace = {module_name}_host_map({NAME}_TRACE_FILE, &len);
+        {module_name}_trace_len = len / sizeof(uint16_t);
+    }}
+#endif
+    if ({module_name}_trace_len == 0) {{
+        LOG_WRN("Traccia %s non disponibile, uso valori casuali", {NAME}_TRACE_FILE);
+    }}
+"""
+    parts["cmake"] = f"""\
+zephyr_library_compile_definitions({NAME}_TRACE_FILE="${{CMAKE_CURRENT_SOURCE_DIR}}/{module_name}_trace.bin")
+if(CONFIG_NATIVE_LIBRARY)
+  target_sources(native_simulator INTERFACE ${{CMAKE_CURRENT_SOURCE_DIR}}/{module_name}_host.c)
+endif()
+"""
+    return parts
+
+def load_calibration(spec):
+    # 'poly:c0,c1,c2,...' means unit = c0 + c1*raw + c2*raw^2 + ...,
+    # anything else is a CSV of measured (raw, unit) points
+    if spec.startswith("poly:"):
+        try:
+            return "poly", [float(c) for c in spec[len("poly:"):].split(",")]
+        except ValueError:
+            raise ValueError(f"Invalid polynomial '{spec}', expected e.g. 'poly:0,0.8333'") from None
+
+    points = []
+    with open(spec, newline="") as f:
+        for row in csv.reader(f):
+            try:
+                points.append((float(row[0]), float(row[1])))
+            except (ValueError, IndexError):
+                continue  # header or comment line
+    if len(points) < 2:
+        raise ValueError(f"Calibration file {spec} needs at least two (raw, unit) points.")
+    return "points", sorted(points)
+
+def c_float(value):
+    text = f"{value:.7g}"
+    if not any(c in text for c in ".e"):
+        text += ".0"
+    return text + "f"
+
+def calibration_parts(module_name, spec, bits=8):
+    try:
+        import numpy as np
+    except ImportError:
+        raise ValueError("numpy is required to generate calibration tables (pip install numpy).") from None
+
+    if not 1 <= bits <= 16:
+        raise ValueError("Calibration table bits must be between 1 and 16.")
+
+    NAME = module_name.upper()
+    kind, data = load_calibration(spec)
+    shift = 16 - bits
+    size = 1 << bits
+
+    # Evaluate the curve at the start of each segment of raw values, plus the end of the last one, all at once
+    raw = np.arange(size + 1, dtype=np.float64) * (1 << shift)
+    if kind == "poly":
+        table = np.polynomial.polynomial.polyval(raw, data)
+    else:
+        xs, ys = np.array(data, dtype=np.float64).T
+        table = np.interp(raw, xs, ys)
+    if not np.all(np.isfinite(table)):
+        raise ValueError(f"Calibration curve '{spec}' is not finite over the raw range.")
+
+    rows = []
+    for i in range(0, size + 1, 8):
+        rows.append("    " + ", ".join(c_float(v) for v in table[i:i + 8]) + ",")
+    source = spec if kind == "poly" else os.path.basename(spec)
+
+    return {
+        "files": {f"{module_name}_cal.h": f"""\
+/*
+ * {module_name}_cal.h
+ * Tabella di calibrazione generata da {source} ({size} segmenti, {size + 1} voci)
+ */
+
+#ifndef {NAME}_CAL_H_
+#define {NAME}_CAL_H_
+
+#define {NAME}_CAL_SHIFT {shift}
+#define {NAME}_CAL_MASK  0x{(1 << shift) - 1:x}
+#define {NAME}_CAL_STEP  {c_float(1 / (1 << shift))}  // 1 / (1 << {NAME}_CAL_SHIFT)
+
+static const float {module_name}_cal_lut[{size + 1}] = {{
+{chr(10).join(rows)}
+}};
+
+#endif  // {NAME}_CAL_H_
+"""},
+        "includes": f'#include "{module_name}_cal.h"\n',
+        "convert": f"""\
+    // Tabella precalcolata: interpolazione lineare tra le due voci che racchiudono raw
+    const float *seg = &{module_name}_cal_lut[raw >> {NAME}_CAL_SHIFT];
+    float frac = (float)(raw & {NAME}_CAL_MASK) * {NAME}_CAL_STEP;
+
+    return seg[0] + (seg[1] - seg[0]) * frac;
+""",
+    }
+
+def bus_timing_parts(module_name, interface):
+    if interface != "i2c":
+        raise ValueError(f"The bus timing model only supports i2c, not '{interface}'.")
+
+    NAME = module_name.upper()
+    return {
+        "includes": "#include <zephyr/kernel.h>\n#include <zephyr/sys/byteorder.h>\n",
+        "data_fields": "    uint64_t bus_busy_us;        // tempo totale di bus occupato\n",
+        "cfg_fields": "    const struct device *bus;\n    uint32_t bitrate;\n",
+        "cfg_init": f"""\
+        .bus = DEVICE_DT_GET(DT_INST_BUS(n)), \\
+        .bitrate = DT_PROP_OR(DT_INST_BUS(n), clock_frequency, I2C_BITRATE_STANDARD), \\
+""",
+        "helpers": f"""\
+#ifdef CONFIG_{NAME}_BUS_TIMING
+// -----------------------------------------------------------------------------
+// Modello temporale del bus I2C
+
+// Ogni byte costa 9 bit (8 dati + ACK), ogni messaggio aggiunge START/RESTART e
+// byte di indirizzo; la transazione aggiunge lo STOP e un overhead fisso
+static uint32_t {module_name}_bus_cost_us(uint32_t bitrate, const struct i2c_msg *msgs, int num_msgs)
+{{
+    uint32_t bits = 1;
+
+    for (int i = 0; i < num_msgs; i++) {{
+        bits += 1 + 9 + 9 * msgs[i].len;
+    }}
+    return CONFIG_{NAME}_BUS_OVERHEAD_US + DIV_ROUND_UP((uint64_t)bits * USEC_PER_SEC, bitrate);
+}}
+#endif
+
+""",
+        "fetch_post": f"""\
+#ifdef CONFIG_{NAME}_BUS_TIMING
+    // Rilettura dal bus emulato: il tempo di trasferimento viene addebitato da _transfer
+    const struct {module_name}_cfg *cfg = dev->config;
+    uint8_t buf[2];
+    int ret = i2c_read(cfg->bus, buf, sizeof(buf), cfg->addr);
+
+    if (ret < 0) {{
+        return ret;
+    }}
+    data->raw_data = sys_get_be16(buf);
+#endif
+""",
+        "transfer": f"""\
+#ifdef CONFIG_{NAME}_BUS_TIMING
+    uint32_t cost_us = {module_name}_bus_cost_us(cfg->bitrate, msgs, num_msgs);
+
+    data->bus_busy_us += cost_us;
+    k_busy_wait(cost_us);
+#endif
+
+""",
+        "init": f"""\
+#ifdef CONFIG_{NAME}_BUS_TIMING
+    const struct {module_name}_cfg *cfg = target->cfg;
+    uint8_t buf[2];
+    struct i2c_msg msg = {{ .buf = buf, .len = sizeof(buf), .flags = I2C_MSG_READ | I2C_MSG_STOP }};
+    uint32_t read_us = {module_name}_bus_cost_us(cfg->bitrate, &msg, 1);
+
+    LOG_INF("%s: bus a %u Hz, lettura %u us, max %u campioni/s",
+            target->dev->name, cfg->bitrate, read_us, USEC_PER_SEC / read_us);
+#endif
+""",
+        "kconfig": f"""\
+
+config {NAME}_BUS_TIMING
+        bool "Charge simulated I2C transfer time in the {module_name} emulator"
+  default y
+        depends on {NAME}
+        help
+          Each transfer busy-waits for the time it would take on a real bus at
+          the controller clock-frequency, plus a fixed per-transaction overhead.
+
+config {NAME}_BUS_OVERHEAD_US
+        int "Per-transaction overhead of the emulated bus (us)"
+  default 20
+        depends on {NAME}_BUS_TIMING
+""",
+    }
+
+def trigger_parts(module_name):
+    NAME = module_name.upper()
+    return {
+        "includes": "#include <zephyr/kernel.h>\n#include <zephyr/drivers/gpio.h>\n#include <zephyr/drivers/gpio/gpio_emul.h>\n",
+        "data_fields": f"""\
+    const struct device *dev;    // device sensore, passato all'handler
+    struct gpio_callback int_cb;
+    struct k_work int_work;
+    struct k_timer drdy_timer;   // genera il data-ready sulla linea INT emulata
+    sensor_trigger_handler_t handler;
+    const struct sensor_trigger *trigger;
+""",
+        "cfg_fields": "    struct gpio_dt_spec int_gpio;\n",
+        "cfg_init": "        .int_gpio = GPIO_DT_SPEC_INST_GET_OR(n, int_gpios, {0}), \\\n",
+        "helpers": f"""\
+// -----------------------------------------------------------------------------
+// Trigger data-ready (linea INT pilotata dal GPIO emulator)
+
+// Il timer simula il sensore che ha un nuovo campione: impulso sulla linea INT
+static void {module_name}_drdy_expiry(struct k_timer *timer)
+{{
+    struct {module_name}_data *data = CONTAINER_OF(timer, struct {module_name}_data, drdy_timer);
+    const struct {module_name}_cfg *cfg = data->dev->config;
+
+    gpio_emul_input_set(cfg->int_gpio.port, cfg->int_gpio.pin, 1);
+    gpio_emul_input_set(cfg->int_gpio.port, cfg->int_gpio.pin, 0);
+}}
+
+// Callback GPIO (contesto ISR): l'handler dell'applicazione gira nel system workqueue
+static void {module_name}_int_callback(const struct device *port, struct gpio_callback *cb,
+                                       gpio_port_pins_t pins)
+{{
+    struct {module_name}_data *data = CONTAINER_OF(cb, struct {module_name}_data, int_cb);
+
+    ARG_UNUSED(port);
+    ARG_UNUSED(pins);
+    k_work_submit(&data->int_work);
+}}
+
+static void {module_name}_int_work(struct k_work *work)
+{{
+    struct {module_name}_data *data = CONTAINER_OF(work, struct {module_name}_data, int_work);
+    sensor_trigger_handler_t handler = data->handler;
+
+    if (handler != NULL) {{
+        handler(data->dev, data->trigger);
+    }}
+}}
+
+static int {module_name}_trigger_set(const struct device *dev,
+                                     const struct sensor_trigger *trig,
+                                     sensor_trigger_handler_t handler)
+{{
+    const struct {module_name}_cfg *cfg = dev->config;
+    struct {module_name}_data *data = dev->data;
+    int ret;
+
+    if (trig->type != SENSOR_TRIG_DATA_READY) {{
+        return -ENOTSUP;
+    }}
+    if (cfg->int_gpio.port == NULL) {{
+        return -ENOTSUP;  // manca 'int-gpios' nel devicetree
+    }}
+    if (!gpio_is_ready_dt(&cfg->int_gpio)) {{
+        return -ENODEV;
+    }}
+
+    k_timer_stop(&data->drdy_timer);
+    data->handler = handler;
+    data->trigger = trig;
+    if (handler == NULL) {{
+        return gpio_pin_interrupt_configure_dt(&cfg->int_gpio, GPIO_INT_DISABLE);
+    }}
+
+    ret = gpio_pin_configure_dt(&cfg->int_gpio, GPIO_INPUT);
+    if (ret < 0) {{
+        return ret;
+    }}
+    gpio_init_callback(&data->int_cb, {module_name}_int_callback, BIT(cfg->int_gpio.pin));
+    ret = gpio_add_callback(cfg->int_gpio.port, &data->int_cb);
+    if (ret < 0) {{
+        return ret;
+    }}
+    ret = gpio_pin_interrupt_configure_dt(&cfg->int_gpio, GPIO_INT_EDGE_TO_ACTIVE);
+    if (ret < 0) {{
+        return ret;
+    }}
+
+    k_timer_start(&data->drdy_timer, K_MSEC(CONFIG_{NAME}_DRDY_PERIOD_MS),
+                  K_MSEC(CONFIG_{NAME}_DRDY_PERIOD_MS));
+    return 0;
+}}
+
+""",
+        "init": f"""\
+    data->dev = target->dev;
+    k_work_init(&data->int_work, {module_name}_int_work);
+    k_timer_init(&data->drdy_timer, {module_name}_drdy_expiry, NULL);
+""",
+        "api": f"    .trigger_set = {module_name}_trigger_set,\n",
+        "kconfig": f"""\
+
+config {NAME}_DRDY_PERIOD_MS
+        int "Data-ready period of the emulated {module_name} (ms)"
+  default 1000
+        depends on {NAME}
+        help
+          How often the emulator pulses its int-gpios line once a data-ready
+          trigger is set.
+""",
+        "binding": """\
+
+properties:
+  int-gpios:
+    type: phandle-array
+    description: Data-ready line, driven through the GPIO emulator
+""",
+    }
+
+def pm_parts(module_name):
+    NAME = module_name.upper()
+    return {
+        "includes": "#include <zephyr/kernel.h>\n#include <zephyr/pm/device.h>\n#include <zephyr/pm/device_runtime.h>\n",
+        "data_fields": """\
+    bool powered_on;             // gestito dal runtime PM
+    int64_t on_since;            // tick dell'ultima accensione
+    int64_t powered_ticks;       // tempo totale acceso (tick)
+    uint32_t power_ons;
+    const struct device *pm_dev;
+    struct k_work_delayable pm_report;
+""",
+        "helpers": f"""\
+#ifdef CONFIG_PM_DEVICE
+// -----------------------------------------------------------------------------
+// Power management (runtime PM): latenza di accensione e tempo acceso
+
+static int {module_name}_pm_action(const struct device *dev, enum pm_device_action action)
+{{
+    struct {module_name}_data *data = dev->data;
+
+    switch (action) {{
+    case PM_DEVICE_ACTION_RESUME:
+        k_busy_wait(CONFIG_{NAME}_POWER_ON_US);  // tempo di accensione del sensore
+        data->powered_on = true;
+        data->on_since = k_uptime_ticks();
+        data->power_ons++;
+        break;
+    case PM_DEVICE_ACTION_SUSPEND:
+        data->powered_on = false;
+        data->powered_ticks += k_uptime_ticks() - data->on_since;
+        break;
+    case PM_DEVICE_ACTION_TURN_ON:
+    case PM_DEVICE_ACTION_TURN_OFF:
+        break;
+    default:
+        return -ENOTSUP;
+    }}
+    return 0;
+}}
+
+// Report periodico: tempo acceso rispetto all'uptime e numero di accensioni
+static void {module_name}_pm_report(struct k_work *work)
+{{
+    struct k_work_delayable *dwork = k_work_delayable_from_work(work);
+    struct {module_name}_data *data = CONTAINER_OF(dwork, struct {module_name}_data, pm_report);
+    int64_t now = k_uptime_ticks();
+    int64_t on = data->powered_ticks + (data->powered_on ? now - data->on_since : 0);
+
+    LOG_INF("%s: acceso %u ms su %u ms (%u%%), %u accensioni",
+            data->pm_dev->name, (uint32_t)k_ticks_to_ms_floor64(on), (uint32_t)k_ticks_to_ms_floor64(now),
+            (uint32_t)(now > 0 ? 100 * on / now : 0), data->power_ons);
+    k_work_reschedule(dwork, K_MSEC(CONFIG_{NAME}_PM_REPORT_MS));
+}}
+#endif
+
+// Il device parte sospeso: il runtime PM lo accende al primo pm_device_runtime_get()
+static int {module_name}_device_init(const struct device *dev)
+{{
+#ifdef CONFIG_PM_DEVICE
+    struct {module_name}_data *data = dev->data;
+
+    data->pm_dev = dev;
+    k_work_init_delayable(&data->pm_report, {module_name}_pm_report);
+    if (CONFIG_{NAME}_PM_REPORT_MS > 0) {{
+        k_work_schedule(&data->pm_report, K_MSEC(CONFIG_{NAME}_PM_REPORT_MS));
+    }}
+#endif
+    pm_device_init_suspended(dev);
+    return pm_device_runtime_enable(dev);
+}}
+
+""",
+        "fetch_pre": """\
+#ifdef CONFIG_PM_DEVICE
+    if (!data->powered_on) {
+        return -EIO;  // sospeso: serve pm_device_runtime_get()
+    }
+#endif
+""",
+        "device_pre": f"    PM_DEVICE_DT_INST_DEFINE(n, {module_name}_pm_action); \\\n",
+        "device_init": f"{module_name}_device_init",
+        "device_pm": "PM_DEVICE_DT_INST_GET(n)",
+        "kconfig": f"""\
+
+config {NAME}_POWER_ON_US
+        int "Power-on latency of the emulated {module_name} (us)"
+  default 1000
+        depends on {NAME} && PM_DEVICE
+        help
+          Resuming the device busy-waits this long, so every
+          pm_device_runtime_get() that powers it up pays the latency.
+
+config {NAME}_PM_REPORT_MS
+        int "Interval of the powered-time report (ms, 0 disables it)"
+  default 10000
+        depends on {NAME} && PM_DEVICE
+""",
+    }
+
+def shm_parts(module_name):
+    NAME = module_name.upper()
+    return {
+        "data_fields": f"""\
+    struct {module_name}_shm_slot *shm_slot;  // slot dell'istanza nella memoria condivisa
+    uint16_t shm_last;           // ultimo campione letto in modalita' stream
+""",
+        "cfg_fields": "    uint8_t inst;                // indice dell'istanza (slot nella memoria condivisa)\n",
+        "cfg_init": "        .inst = n, \\\n",
+        "helpers": f"""\
+// -----------------------------------------------------------------------------
+// Iniezione di valori dall'host: regione mmap condivisa (solo native_sim)
+// Layout letto anche da scripts/zephyr_shm.py: header, poi uno slot per istanza
+
+#define {NAME}_SHM_MAGIC   0x48534D45  // 'EMSH'
+#define {NAME}_SHM_VERSION 1
+
+enum {module_name}_shm_mode {{
+    {NAME}_SHM_OFF = 0,      // nessuna iniezione
+    {NAME}_SHM_VALUE = 1,    // valore fisso in 'value'
+    {NAME}_SHM_LOOP = 2,     // forma d'onda wave[0..len) ripetuta
+    {NAME}_SHM_STREAM = 3,   // coda circolare: l'host avanza head, l'emulatore tail
+}};
+
+struct {module_name}_shm_header {{
+    uint32_t magic;
+    uint16_t version;
+    uint16_t slots;
+    uint32_t capacity;           // campioni per slot
+    uint32_t slot_size;          // byte per slot
+}};
+
+struct {module_name}_shm_slot {{
+    uint32_t mode;               // scritto dall'host
+    uint32_t len;                // LOOP: lunghezza della forma d'onda
+    uint32_t head;               // STREAM: campioni scritti dall'host (contatore libero)
+    uint32_t tail;               // campioni consumati dall'emulatore (contatore libero)
+    uint16_t value;              // VALUE
+    uint16_t reserved;
+    uint16_t wave[];
+}};
+
+#define {NAME}_SHM_SLOTS     DT_NUM_INST_STATUS_OKAY(DT_DRV_COMPAT)
+#define {NAME}_SHM_SLOT_SIZE ROUND_UP(sizeof(struct {module_name}_shm_slot) + \\
+                                  CONFIG_{NAME}_SHM_CAPACITY * sizeof(uint16_t), 8)
+#define {NAME}_SHM_SIZE      (sizeof(struct {module_name}_shm_header) + {NAME}_SHM_SLOTS * {NAME}_SHM_SLOT_SIZE)
+
+#ifdef CONFIG_NATIVE_LIBRARY
+extern void *{module_name}_shm_host_map(const char *path, size_t len);
+#endif
+
+static struct {module_name}_shm_header *{module_name}_shm;
+
+// Prossimo campione iniettato dall'host, false se lo slot e' spento
+static bool {module_name}_shm_next(struct {module_name}_data *data, uint16_t *raw)
+{{
+    struct {module_name}_shm_slot *slot = data->shm_slot;
+    uint32_t tail;
+
+    if (slot == NULL) {{
+        return false;
+    }}
 
-def create_structure(base_path, module_name, interface, category):
-    module_path = os.path.join(base_path, module_name)  # module root dir
+    switch (__atomic_load_n(&slot->mode, __ATOMIC_ACQUIRE)) {{
+    case {NAME}_SHM_VALUE:
+        *raw = slot->value;
+        return true;
+    case {NAME}_SHM_LOOP: {{
+        uint32_t len = slot->len;
+
+        if (len == 0 || len > CONFIG_{NAME}_SHM_CAPACITY) {{
+            return false;
+        }}
+        tail = slot->tail;
+        *raw = slot->wave[tail % len];
+        __atomic_store_n(&slot->tail, tail + 1, __ATOMIC_RELEASE);
+        return true;
+    }}
+    case {NAME}_SHM_STREAM:
+        tail = slot->tail;
+        // Coda vuota: si ripete l'ultimo campione finche' l'host non ne scrive altri
+        if (tail != __atomic_load_n(&slot->head, __ATOMIC_ACQUIRE)) {{
+            data->shm_last = slot->wave[tail % CONFIG_{NAME}_SHM_CAPACITY];
+            __atomic_store_n(&slot->tail, tail + 1, __ATOMIC_RELEASE);
+        }}
+        *raw = data->shm_last;
+        return true;
+    default:
+        return false;
+    }}
+}}
+
+""",
+        "fetch": f"""\
+    uint16_t shm_raw;
+
+    if ({module_name}_shm_next(data, &shm_raw)) {{
+        return shm_raw;
+    }}
+
+""",
+        "init": f"""\
+#ifdef CONFIG_NATIVE_LIBRARY
+    if ({module_name}_shm == NULL) {{
+        {module_name}_shm = {module_name}_shm_host_map(CONFIG_{NAME}_SHM_PATH, {NAME}_SHM_SIZE);
+        if ({module_name}_shm != NULL) {{
+            {module_name}_shm->version = {NAME}_SHM_VERSION;
+            {module_name}_shm->slots = {NAME}_SHM_SLOTS;
+            {module_name}_shm->capacity = CONFIG_{NAME}_SHM_CAPACITY;
+            {module_name}_shm->slot_size = {NAME}_SHM_SLOT_SIZE;
+            // Il magic per ultimo: il client attende questo per leggere il layout
+            __atomic_store_n(&{module_name}_shm->magic, {NAME}_SHM_MAGIC, __ATOMIC_RELEASE);
+        }} else {{
+            LOG_WRN("Memoria condivisa %s non disponibile", CONFIG_{NAME}_SHM_PATH);
+        }}
+    }}
+#endif
+    if ({module_name}_shm != NULL) {{
+        const struct {module_name}_cfg *cfg = target->cfg;
+
+        data->shm_slot = (struct {module_name}_shm_slot *)((uint8_t *)({module_name}_shm + 1) +
+                                                          cfg->inst * {NAME}_SHM_SLOT_SIZE);
+    }}
+""",
+        "files": {f"{module_name}_shm_host.c": f"""\
+/*
+ * {module_name}_shm_host.c
+ * Lato host (native_sim): compilato con la libc del PC, non con quella di Zephyr
+ */
+
+#include <fcntl.h>
+#include <stddef.h>
+#include <sys/mman.h>
+#include <unistd.h>
+
+// Crea (o azzera) un file del PC e lo mappa in lettura/scrittura condivisa con altri processi
+void *{module_name}_shm_host_map(const char *path, size_t len)
+{{
+    void *addr;
+    int fd = open(path, O_RDWR | O_CREAT, 0600);
+
+    if (fd < 0) {{
+        return NULL;
+    }}
+    // Riparte da zero: i valori di un'esecuzione precedente non devono restare
+    if (ftruncate(fd, 0) < 0 || ftruncate(fd, len) < 0) {{
+        close(fd);
+        return NULL;
+    }}
+    addr = mmap(NULL, len, PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0);
+    close(fd);
+    return addr == MAP_FAILED ? NULL : addr;
+}}
+"""},
+        "cmake": f"""\
+if(CONFIG_NATIVE_LIBRARY)
+  target_sources(native_simulator INTERFACE ${{CMAKE_CURRENT_SOURCE_DIR}}/{module_name}_shm_host.c)
+endif()
+""",
+        "kconfig": f"""\
+
+config {NAME}_SHM_PATH
+        string "Host file shared with scripts/zephyr_shm.py"
+  default "/dev/shm/{module_name}"
+        depends on {NAME}
+        help
+          native_sim maps this file and reads injected values from it on
+          every sample_fetch. Other boards ignore it.
+
+config {NAME}_SHM_CAPACITY
+        int "Samples per instance in the shared region"
+  default 4096
+        depends on {NAME}
+""",
+    }
+
+def ztest_files(module_name, interface, trigger=False, pm=False, bench_runs=1000):
+    # ztest app for one driver, built against the module two levels up (tests/<driver>/)
+    NAME = module_name.upper()
+    bus = interface.upper()
+    addr = 0x10
+
+    prj_extra = "".join(f"CONFIG_{symbol}=y\n" for symbol in
+                        (("GPIO", "GPIO_EMUL") if trigger else ()) + (("PM_DEVICE", "PM_DEVICE_RUNTIME") if pm else ()))
+    gpio_node = "\n&gpio0 {\n    status = \"okay\";\n};\n" if trigger else ""
+    int_line = "        int-gpios = <&gpio0 1 0>;\n" if trigger else ""
+
+    pm_include = "#include <zephyr/pm/device_runtime.h>\n" if pm else ""
+    pm_get = "\n    zassert_ok(pm_device_runtime_get(dev));  // suspended devices refuse sample_fetch\n" if pm else "\n"
+    pm_put = "    pm_device_runtime_put(dev);\n" if pm else ""
+    after = f"""
+static void {module_name}_after(void *fixture)
+{{
+    ARG_UNUSED(fixture);
+{pm_put}}}
+""" if pm else ""
+
+    trigger_test = f"""
+static K_SEM_DEFINE(drdy_sem, 0, 1);
+
+static void drdy_handler(const struct device *trig_dev, const struct sensor_trigger *trig)
+{{
+    ARG_UNUSED(trig_dev);
+    ARG_UNUSED(trig);
+    k_sem_give(&drdy_sem);
+}}
+
+ZTEST({module_name}, test_data_ready_trigger)
+{{
+    struct sensor_trigger trig = {{
+        .type = SENSOR_TRIG_DATA_READY,
+        .chan = SENSOR_CHAN_ALL,
+    }};
+
+    zassert_ok(sensor_trigger_set(dev, &trig, drdy_handler));
+    zassert_ok(k_sem_take(&drdy_sem, K_MSEC(3 * CONFIG_{NAME}_DRDY_PERIOD_MS)), "no data-ready interrupt");
+    zassert_ok(sensor_trigger_set(dev, &trig, NULL));
+}}
+""" if trigger else ""
+
+    main_c = f"""\
+/*
+ * Tests and hot-path benchmarks for the {module_name} emulator
+ * (generated by zephyr_driver_emul.py)
+ */
+
+#include <zephyr/ztest.h>
+#include <zephyr/device.h>
+#include <zephyr/drivers/emul.h>
+#include <zephyr/drivers/{interface}.h>
+#include <zephyr/drivers/sensor.h>
+#include <zephyr/sys/byteorder.h>
+#include <zephyr/timing/timing.h>
+{pm_include}#include <stdlib.h>
+
+#include "{module_name}.h"
+
+#define {NAME}_NODE DT_INST(0, {module_name})
+#define BENCH_RUNS  {bench_runs}
+
+static const struct device *const dev = DEVICE_DT_GET({NAME}_NODE);
+static const struct emul *const emul = EMUL_DT_GET({NAME}_NODE);
+static const struct device *const bus = DEVICE_DT_GET(DT_BUS({NAME}_NODE));
+static const uint16_t addr = DT_REG_ADDR({NAME}_NODE);
+
+static uint32_t cycles[BENCH_RUNS];
+
+static void *{module_name}_setup(void)
+{{
+    zassert_true(device_is_ready(dev), "%s not ready", dev->name);
+    timing_init();
+    return NULL;
+}}
+
+static void {module_name}_before(void *fixture)
+{{
+    ARG_UNUSED(fixture);
+    zassert_ok({module_name}_reset(emul));{pm_get}}}
+{after}
+ZTEST_SUITE({module_name}, NULL, {module_name}_setup, {module_name}_before, {"{}_after".format(module_name) if pm else "NULL"}, NULL);
+
+ZTEST({module_name}, test_sample_fetch_dequeues)
+{{
+    const uint16_t raw[] = {{ 0x0000, 0x1234, 0xFFFF }};
+    struct {module_name}_counters counters;
+
+    zassert_equal({module_name}_enqueue_raw(emul, raw, ARRAY_SIZE(raw)), ARRAY_SIZE(raw));
+    for (size_t i = 0; i < ARRAY_SIZE(raw); i++) {{
+        zassert_ok(sensor_sample_fetch(dev));
+    }}
+    zassert_ok({module_name}_get_counters(emul, &counters));
+    zassert_equal(counters.fetches, ARRAY_SIZE(raw));
+    zassert_equal(counters.dequeued, ARRAY_SIZE(raw));
+    zassert_equal(counters.queued, 0);
+}}
+
+ZTEST({module_name}, test_enqueue_bounded)
+{{
+    static uint16_t raw[CONFIG_{NAME}_QUEUE_SIZE + 1];
+
+    zassert_equal({module_name}_enqueue_raw(emul, raw, ARRAY_SIZE(raw)), CONFIG_{NAME}_QUEUE_SIZE);
+    zassert_equal({module_name}_enqueue_raw(emul, raw, 1), 0);
+}}
+
+ZTEST({module_name}, test_channel_get)
+{{
+    struct sensor_value a, b;
+
+    zassert_ok({module_name}_set_raw(dev, 0x1234));
+    zassert_ok(sensor_sample_fetch(dev));
+    zassert_ok(sensor_channel_get(dev, SENSOR_CHAN_LIGHT, &a));
+    zassert_ok(sensor_sample_fetch(dev));
+    zassert_ok(sensor_channel_get(dev, SENSOR_CHAN_LIGHT, &b));
+    zassert_true(a.val1 == b.val1 && a.val2 == b.val2, "same raw, different value");
+    zassert_equal(sensor_channel_get(dev, SENSOR_CHAN_ACCEL_X, &a), -EIO);
+}}
+
+ZTEST({module_name}, test_transfer)
+{{
+    uint8_t buf[2];
+    uint8_t cmd = 0x01;
+    uint8_t bad = 0xFF;
+    struct {module_name}_counters before, after;
+
+    zassert_ok({module_name}_set_raw(dev, 0xABCD));
+    zassert_ok(sensor_sample_fetch(dev));
+    zassert_ok({module_name}_get_counters(emul, &before));
+
+    zassert_ok({interface}_read(bus, buf, sizeof(buf), addr));
+    zassert_equal(sys_get_be16(buf), 0xABCD);
+    zassert_ok({interface}_write(bus, &cmd, 1, addr));
+    zassert_not_equal({interface}_write(bus, &bad, 1, addr), 0);
+    zassert_not_equal({interface}_read(bus, buf, 1, addr), 0);
+
+    zassert_ok({module_name}_get_counters(emul, &after));
+    zassert_equal(after.transfers - before.transfers, 4);
+}}
+{trigger_test}
+// -----------------------------------------------------------------------------
+// Per-call latency in cycles (timing API): one 'BENCH' line per call
+
+static int cmp_u32(const void *a, const void *b)
+{{
+    uint32_t x = *(const uint32_t *)a, y = *(const uint32_t *)b;
+
+    return (x > y) - (x < y);
+}}
+
+static void bench_report(const char *name)
+{{
+    uint64_t sum = 0;
+
+    qsort(cycles, BENCH_RUNS, sizeof(cycles[0]), cmp_u32);
+    for (size_t i = 0; i < BENCH_RUNS; i++) {{
+        sum += cycles[i];
+    }}
+    TC_PRINT("BENCH {module_name} %-14s min %u mean %u p99 %u cycles (p99 %u ns)\\n", name,
+             cycles[0], (uint32_t)(sum / BENCH_RUNS), cycles[BENCH_RUNS * 99 / 100],
+             (uint32_t)timing_cycles_to_ns(cycles[BENCH_RUNS * 99 / 100]));
+}}
+
+#define BENCH(name, call)                                                \\
+    do {{                                                                 \\
+        for (size_t i = 0; i < BENCH_RUNS; i++) {{                        \\
+            timing_t start = timing_counter_get();                       \\
+            (void)(call);                                                \\
+            timing_t end = timing_counter_get();                         \\
+            cycles[i] = (uint32_t)timing_cycles_get(&start, &end);       \\
+        }}                                                                \\
+        bench_report(name);                                              \\
+    }} while (0)
+
+ZTEST({module_name}, test_bench)
+{{
+    struct sensor_value val;
+    uint8_t buf[2];
+
+    zassert_ok({module_name}_set_raw(dev, 0x1234));
+    timing_start();
+    BENCH("sample_fetch", sensor_sample_fetch(dev));
+    BENCH("channel_get", sensor_channel_get(dev, SENSOR_CHAN_LIGHT, &val));
+    BENCH("{interface}_read", {interface}_read(bus, buf, sizeof(buf), addr));
+    timing_stop();
+}}
+"""
+
+    return {
+        "CMakeLists.txt": f"""\
+cmake_minimum_required(VERSION 3.20.0)
+
+# The driver module is two levels up (<module>/tests/{module_name})
+set(ZEPHYR_EXTRA_MODULES ${{CMAKE_CURRENT_SOURCE_DIR}}/../..)
+
+find_package(Zephyr REQUIRED HINTS $ENV{{ZEPHYR_BASE}})
+project({module_name}_test)
+
+target_sources(app PRIVATE src/main.c)
+""",
+        "prj.conf": f"""\
+CONFIG_ZTEST=y
+CONFIG_EMUL=y
+CONFIG_{bus}=y
+CONFIG_{bus}_EMUL=y
+CONFIG_SENSOR=y
+CONFIG_{NAME}=y
+CONFIG_TIMING_FUNCTIONS=y
+{prj_extra}""",
+        "testcase.yaml": f"""\
+tests:
+  drivers.sensor.{module_name}:
+    platform_allow: native_sim
+    integration_platforms:
+      - native_sim
+    tags: sensors emul
+""",
+        "boards/native_sim.overlay": f"""\
+&{interface}0 {{
+    status = "okay";
+
+    sensor@{addr:x} {{
+        compatible = "{compatible_of(module_name)}";
+        reg = <0x{addr:x}>;
+{int_line}        status = "okay";
+    }};
+}};
+{gpio_node}""",
+        "src/main.c": main_c,
+    }
+
+def create_structure(
+    base_path,
+    module_name,
+    interface,
+    category,
+    fs=None,
+    *,
+    trace: str | None = None,            # CSV or .bin capture replayed by sample_fetch
+    trace_column: int = 0,
+    trace_inline_max: int = 4096,        # above this many samples the trace is streamed (native_sim)
+    calibration: str | None = None,      # 'poly:c0,c1,...' or CSV of (raw, unit) points
+    calibration_bits: int = 8,           # lookup table has 2**bits segments, interpolated
+    bus_timing: bool = False,            # charge simulated time per transferred byte
+    trigger: bool = False,               # data-ready trigger on an emulated int-gpios line
+    pm: bool = False,                    # device runtime PM with modelled power-on latency
+    shm: bool = False,                   # host-injected values over a shared mmap region (native_sim)
+    aggregate: str | None = None,        # shared module holding every driver, e.g. 'emul_drivers'
+):
+    fs = fs or DiskFS()
+    module_path = os.path.join(base_path, aggregate or module_name)  # module root dir
+
+    features = []
+    try:
+        if shm:
+            features.append(shm_parts(module_name))  # live host values take precedence over the trace
+        if trace:
+            samples = load_trace(trace, trace_column)
+            if not samples:
+                raise ValueError(f"No samples found in {trace}.")
+            features.append(trace_parts(module_name, samples, trace, trace_inline_max))
+        if calibration:
+            features.append(calibration_parts(module_name, calibration, calibration_bits))
+        if bus_timing:
+            features.append(bus_timing_parts(module_name, interface))
+        if trigger:
+            features.append(trigger_parts(module_name))
+        if pm:
+            features.append(pm_parts(module_name))
+    except (ValueError, OSError) as e:
+        return [Change(module_path, "error", f"Error: {e}")]
+    parts = merge_parts(*features)
+
+    raw_to_unit_body = parts["convert"] or """\
+    // TODO: personalizza la formula secondo il tuo sensore
+    return raw / 1.2f;
+"""
 
     # Prepare contents for root files
     cmake_root_content = """\
@@ -516,7 +1879,19 @@ rsource "{module_name}/Kconfig"
 zephyr_library()
 zephyr_library_sources({module_name}.c)
 zephyr_include_directories(.)
-"""
+if(EMUL_PCH)
+  # The first driver precompiles the shared Zephyr headers, the others reuse them
+  get_property(emul_pch_library GLOBAL PROPERTY EMUL_PCH_LIBRARY)
+  if(NOT emul_pch_library)
+    set_property(GLOBAL PROPERTY EMUL_PCH_LIBRARY ${{ZEPHYR_CURRENT_LIBRARY}})
+    target_precompile_headers(${{ZEPHYR_CURRENT_LIBRARY}} PRIVATE
+      <zephyr/kernel.h> <zephyr/device.h> <zephyr/logging/log.h> <zephyr/drivers/emul.h>
+      <zephyr/drivers/{interface}.h> <zephyr/drivers/{interface}_emul.h> <zephyr/drivers/sensor.h> <zephyr/random/random.h>)
+  else()
+    target_precompile_headers(${{ZEPHYR_CURRENT_LIBRARY}} REUSE_FROM ${{emul_pch_library}})
+  endif()
+endif()
+{parts["cmake"]}"""
 
     kconfig_emul_content = f"""\
 config {module_name.upper()}
@@ -525,7 +1900,14 @@ config {module_name.upper()}
         depends on EMUL
         help
           This is an emulator for the {module_name} sensor.
-"""
+
+config {module_name.upper()}_QUEUE_SIZE
+        int "Raw samples the test backdoor can queue per instance"
+  default 256
+        depends on {module_name.upper()}
+        help
+          Size of the ring filled by {module_name}_enqueue_raw().
+{parts["kconfig"]}"""
 
     c_content = f"""\
 /*
@@ -544,38 +1926,77 @@ LOG_MODULE_REGISTER({'_'.join(module_name.split('_')[-2:])}, CONFIG_{interface.u
 #include <zephyr/drivers/{interface}_emul.h>
 #include <zephyr/drivers/sensor.h>  // TODO: rimuovi se non è un sensore
 #include <zephyr/random/random.h>
+#include <zephyr/spinlock.h>
 #include <string.h>
 #include <errno.h>
 
+#include "{module_name}.h"
+{parts["includes"]}
 // -----------------------------------------------------------------------------
 // Strutture dati del driver emulato
 
 // TODO: adatta i campi secondo le caratteristiche del tuo dispositivo
 struct {module_name}_data {{
     uint16_t raw_data;           // esempio: valore grezzo
+    bool raw_forced;             // valore imposto con {module_name}_set_raw()
+    uint16_t forced_raw;
+    uint16_t queue[CONFIG_{module_name.upper()}_QUEUE_SIZE];  // coda della backdoor ({module_name}_enqueue_raw)
+    size_t queue_head;
+    size_t queue_len;
+    struct k_spinlock queue_lock;
+    struct {module_name}_counters counters;
     //bool powered_on;
-}};
+{parts["data_fields"]}}};
 
 // Configurazione statica
 // TODO: estendi se servono altri parametri dal devicetree
 struct {module_name}_cfg {{
     uint16_t addr;
-}};
+{parts["cfg_fields"]}}};
 
 // -----------------------------------------------------------------------------
 // Funzione di conversione raw → unità fisica (se sensore)
 
 static float raw_to_unit(uint16_t raw)
 {{
-    // TODO: personalizza la formula secondo il tuo sensore
-    return raw / 1.2f;
-}}
+{raw_to_unit_body}}}
 
-// -----------------------------------------------------------------------------
+{parts["helpers"]}// -----------------------------------------------------------------------------
 // API standard (sensor_driver_api) se usi driver sensor Zephyr
 
 // TODO: rimuovi se non usi il framework sensor
 
+// Primo campione accodato dalla backdoor, false se la coda è vuota
+static bool {module_name}_queue_pop(struct {module_name}_data *data, uint16_t *raw)
+{{
+    k_spinlock_key_t key = k_spin_lock(&data->queue_lock);
+    bool found = data->queue_len > 0;
+
+    if (found) {{
+        *raw = data->queue[data->queue_head];
+        data->queue_head = (data->queue_head + 1) % CONFIG_{module_name.upper()}_QUEUE_SIZE;
+        data->queue_len--;
+        data->counters.dequeued++;
+    }}
+    k_spin_unlock(&data->queue_lock, key);
+    return found;
+}}
+
+// Prossimo valore grezzo prodotto dal sensore emulato
+static uint16_t {module_name}_next_raw(struct {module_name}_data *data)
+{{
+    uint16_t queued;
+
+    if ({module_name}_queue_pop(data, &queued)) {{
+        return queued;
+    }}
+    if (data->raw_forced) {{
+        return data->forced_raw;
+    }}
+
+{parts["fetch"]}    return 0x2000 + (sys_rand32_get() % 0x1000);  // TODO: sostituisci con logica realistica
+}}
+
 static int {module_name}_sample_fetch(const struct device *dev, enum sensor_channel chan)
 {{
     struct {module_name}_data *data = dev->data;
@@ -585,9 +2006,10 @@ static int {module_name}_sample_fetch(const struct device *dev, enum sensor_chan
     //if (!data->powered_on) {{
     //    return -EIO;
     //}}
-
-    data->raw_data = 0x2000 + (sys_rand32_get() % 0x1000);  // TODO: sostituisci con logica realistica
-    return 0;
+{parts["fetch_pre"]}
+    data->counters.fetches++;
+    data->raw_data = {module_name}_next_raw(data);
+{parts["fetch_post"]}    return 0;
 }}
 
 static int {module_name}_channel_get(const struct device *dev,
@@ -609,6 +2031,64 @@ static int {module_name}_channel_get(const struct device *dev,
 static const struct sensor_driver_api {module_name}_driver_api = {{
     .sample_fetch = {module_name}_sample_fetch,
     .channel_get = {module_name}_channel_get,
+{parts["api"]}}};
+
+// -----------------------------------------------------------------------------
+// Backdoor per i test (dichiarata in {module_name}.h)
+
+int {module_name}_set_raw(const struct device *dev, uint16_t data_raw)
+{{
+    struct {module_name}_data *data = dev->data;
+
+    data->forced_raw = data_raw;
+    data->raw_forced = true;
+    return 0;
+}}
+
+static int {module_name}_emul_enqueue(const struct emul *target, const uint16_t *raw, size_t count)
+{{
+    struct {module_name}_data *data = target->data;
+    k_spinlock_key_t key = k_spin_lock(&data->queue_lock);
+    size_t n = MIN(count, CONFIG_{module_name.upper()}_QUEUE_SIZE - data->queue_len);
+    size_t tail = (data->queue_head + data->queue_len) % CONFIG_{module_name.upper()}_QUEUE_SIZE;
+    size_t first = MIN(n, CONFIG_{module_name.upper()}_QUEUE_SIZE - tail);
+
+    // Al massimo due copie: fino alla fine del buffer circolare, poi dall'inizio
+    memcpy(&data->queue[tail], raw, first * sizeof(uint16_t));
+    memcpy(data->queue, raw + first, (n - first) * sizeof(uint16_t));
+    data->queue_len += n;
+    k_spin_unlock(&data->queue_lock, key);
+    return n;
+}}
+
+static int {module_name}_emul_get_counters(const struct emul *target, struct {module_name}_counters *counters)
+{{
+    struct {module_name}_data *data = target->data;
+    k_spinlock_key_t key = k_spin_lock(&data->queue_lock);
+
+    *counters = data->counters;
+    counters->queued = data->queue_len;
+    k_spin_unlock(&data->queue_lock, key);
+    return 0;
+}}
+
+static int {module_name}_emul_reset(const struct emul *target)
+{{
+    struct {module_name}_data *data = target->data;
+    k_spinlock_key_t key = k_spin_lock(&data->queue_lock);
+
+    data->queue_head = 0;
+    data->queue_len = 0;
+    memset(&data->counters, 0, sizeof(data->counters));
+    data->raw_forced = false;
+    k_spin_unlock(&data->queue_lock, key);
+    return 0;
+}}
+
+static const struct {module_name}_backdoor_api {module_name}_backdoor_api = {{
+    .enqueue = {module_name}_emul_enqueue,
+    .get_counters = {module_name}_emul_get_counters,
+    .reset = {module_name}_emul_reset,
 }};
 
 // -----------------------------------------------------------------------------
@@ -623,8 +2103,9 @@ static int {module_name}_transfer(const struct emul *target,
     if (cfg->addr != addr) {{
         return -EIO;
     }}
+    data->counters.transfers++;
 
-    // TODO: personalizza la gestione dei comandi I2C
+{parts["transfer"]}    // TODO: personalizza la gestione dei comandi I2C
 
     // Caso: scrittura comando
     if (num_msgs == 1 && !(msgs[0].flags & I2C_MSG_READ)) {{
@@ -677,7 +2158,7 @@ static int {module_name}_init(const struct emul *target, const struct device *pa
 
     //data->powered_on = false;
     data->raw_data = 0x6666;  // TODO: valore iniziale sensato
-    return 0;
+{parts["init"]}    return 0;
 }}
 
 // -----------------------------------------------------------------------------
@@ -687,13 +2168,13 @@ static int {module_name}_init(const struct emul *target, const struct device *pa
     static struct {module_name}_data {module_name}_data_##n; \\
     static const struct {module_name}_cfg {module_name}_cfg_##n = {{ \\
         .addr = DT_INST_REG_ADDR(n), \\
-    }}; \\
-    DEVICE_DT_INST_DEFINE(n, NULL, NULL, \\
+{parts["cfg_init"]}    }}; \\
+{parts["device_pre"]}    DEVICE_DT_INST_DEFINE(n, {parts["device_init"] or "NULL"}, {parts["device_pm"] or "NULL"}, \\
         &{module_name}_data_##n, &{module_name}_cfg_##n, \\
         POST_KERNEL, I2C_INIT_PRIORITY + 1, &{module_name}_driver_api); \\
     EMUL_DT_INST_DEFINE(n, {module_name}_init, \\
         &{module_name}_data_##n, &{module_name}_cfg_##n, \\
-        &{module_name}_api, &{module_name}_driver_api);
+        &{module_name}_api, &{module_name}_backdoor_api);
 
 DT_INST_FOREACH_STATUS_OKAY({module_name.upper()}_EMUL)
 """
@@ -708,39 +2189,35 @@ DT_INST_FOREACH_STATUS_OKAY({module_name.upper()}_EMUL)
 #include <zephyr/device.h>
 #include <zephyr/drivers/emul.h>
 #include <zephyr/drivers/{interface}_emul.h>
+#include <stddef.h>
 #include <stdint.h>
 #include <stdbool.h>
+#include <errno.h>
 
 #ifdef __cplusplus
 extern "C" {{
 #endif
 
 /**
- * @brief {module_name.replace('_', ' ').title()} Emulator API
- *
- * API opzionale per test o manipolazione manuale dell'emulatore.
+ * @brief Contatori dell'emulatore, letti con {module_name}_get_counters()
  */
-struct {module_name}_api {{
-    // TODO: adatta i parametri del metodo 'set' secondo le esigenze del sensore
-    int (*set)(const struct device *dev, uint16_t data_raw);
+struct {module_name}_counters {{
+    uint32_t fetches;    ///< sample_fetch eseguiti
+    uint32_t transfers;  ///< transazioni {interface} ricevute dall'emulatore
+    uint32_t dequeued;   ///< campioni presi dalla coda
+    uint32_t queued;     ///< campioni ancora in coda
 }};
 
 /**
- * @brief Configurazione statica dell'emulatore (da Devicetree)
+ * @brief {module_name.replace('_', ' ').title()} Emulator API
+ *
+ * Backdoor per i test, registrata come backend API dell'emulatore
+ * (EMUL_DT_INST_DEFINE): si usa con l'emul ottenuto da EMUL_DT_GET().
  */
-struct {module_name}_cfg {{
-    uint16_t addr;  ///< Indirizzo I2C assegnato nel devicetree
-}};
-
-/**
- * @brief Stato dinamico del dispositivo emulato
- */
-struct {module_name}_data {{
-    struct {interface}_emul emul;     ///< Struttura base Zephyr per I2C emulator
-    const struct device *{interface}; ///< Controller I2C associato
-
-    // TODO: personalizza i campi runtime secondo il tuo dispositivo
-    uint16_t data_raw;
+struct {module_name}_backdoor_api {{
+    int (*enqueue)(const struct emul *target, const uint16_t *raw, size_t count);
+    int (*get_counters)(const struct emul *target, struct {module_name}_counters *counters);
+    int (*reset)(const struct emul *target);
 }};
 
 /**
@@ -748,32 +2225,67 @@ struct {module_name}_data {{
  *
  * Utile per test automatici (ztest) o simulazioni forzate.
  *
+ * Il valore resta imposto per tutti i sample_fetch successivi.
+ *
  * @param dev        Puntatore al device emulato
  * @param data_raw   Valore grezzo da iniettare
- * @return 0 se ok, -ENOTSUP se API mancante
+ * @return 0
  */
-static inline int {module_name}_set_raw(const struct device *dev, uint16_t data_raw)
+int {module_name}_set_raw(const struct device *dev, uint16_t data_raw);
+
+/**
+ * @brief Accoda campioni grezzi, uno per sample_fetch
+ *
+ * I campioni in coda hanno precedenza su ogni altra sorgente
+ * (set_raw, memoria condivisa, traccia, valori casuali).
+ *
+ * @param target  Emulatore
+ * @param raw     Campioni da accodare
+ * @param count   Numero di campioni
+ * @return campioni accodati (meno di count se la coda è piena), -ENOTSUP se API mancante
+ */
+static inline int {module_name}_enqueue_raw(const struct emul *target, const uint16_t *raw, size_t count)
 {{
-    const struct {module_name}_api *api =
-        (const struct {module_name}_api *)dev->api;
+    const struct {module_name}_backdoor_api *api = target->backend_api;
 
-    if (!api || !api->set) {{
+    if (!api || !api->enqueue) {{
         return -ENOTSUP;
     }}
 
-    return api->set(dev, data_raw);
+    return api->enqueue(target, raw, count);
 }}
 
 /**
- * @brief Simula una lettura e restituisce il valore convertito
+ * @brief Legge i contatori di sample_fetch, transazioni e coda
  *
- * Può essere invocato direttamente in test, senza driver Zephyr.
+ * @return 0 se ok, -ENOTSUP se API mancante
+ */
+static inline int {module_name}_get_counters(const struct emul *target, struct {module_name}_counters *counters)
+{{
+    const struct {module_name}_backdoor_api *api = target->backend_api;
+
+    if (!api || !api->get_counters) {{
+        return -ENOTSUP;
+    }}
+
+    return api->get_counters(target, counters);
+}}
+
+/**
+ * @brief Svuota la coda, azzera i contatori e rimuove il valore di set_raw
  *
- * @param emul   Puntatore all'emulatore
- * @param value  Output: unità fisica simulata (es. lux, °C, %RH, ecc.)
- * @return 0 se ok, errore negativo altrimenti
+ * @return 0 se ok, -ENOTSUP se API mancante
  */
-int {module_name}_sample_fetch(const struct emul *emul, float *value);
+static inline int {module_name}_reset(const struct emul *target)
+{{
+    const struct {module_name}_backdoor_api *api = target->backend_api;
+
+    if (!api || !api->reset) {{
+        return -ENOTSUP;
+    }}
+
+    return api->reset(target);
+}}
 
 #ifdef __cplusplus
 }}
@@ -783,7 +2295,7 @@ int {module_name}_sample_fetch(const struct emul *emul, float *value);
 """
 
     zephyr_module_yaml_content = f"""\
-name: {module_name}
+name: {aggregate or module_name}
 build:
   cmake: .
   kconfig: Kconfig
@@ -791,47 +2303,83 @@ build:
     dts_root: .
 """
 
-    # Write root files
-    write_file(os.path.join(module_path, "CMakeLists.txt"), cmake_root_content)
-    write_file(os.path.join(module_path, "Kconfig"), kconfig_root_content)
-
-    # Write drivers files
+    changes = []
     drivers_path = os.path.join(module_path, "drivers")
-    write_file(os.path.join(drivers_path, "CMakeLists.txt"), cmake_drivers_content)
-    write_file(os.path.join(drivers_path, "Kconfig"), kconfig_drivers_content)
+
+    if aggregate:
+        # One module for all drivers: root files are written once, drivers are appended
+        for path, content in (
+            (os.path.join(module_path, "CMakeLists.txt"), cmake_root_content),
+            (os.path.join(module_path, "Kconfig"), kconfig_root_content),
+            (os.path.join(module_path, "zephyr", "module.yaml"), zephyr_module_yaml_content),
+        ):
+            if not fs.isfile(path):
+                changes.append(write_file(fs, path, content))
+        changes.append(append_line(fs, os.path.join(drivers_path, "CMakeLists.txt"), cmake_drivers_content))
+        changes.append(append_line(fs, os.path.join(drivers_path, "Kconfig"), kconfig_drivers_content))
+    else:
+        # Write root files
+        changes.append(write_file(fs, os.path.join(module_path, "CMakeLists.txt"), cmake_root_content))
+        changes.append(write_file(fs, os.path.join(module_path, "Kconfig"), kconfig_root_content))
+
+        # Write drivers files
+        changes.append(write_file(fs, os.path.join(drivers_path, "CMakeLists.txt"), cmake_drivers_content))
+        changes.append(write_file(fs, os.path.join(drivers_path, "Kconfig"), kconfig_drivers_content))
 
     # Write module driver files
     emul_path = os.path.join(drivers_path, module_name)
-    write_file(os.path.join(emul_path, "CMakeLists.txt"), cmake_emul_content)
-    write_file(os.path.join(emul_path, "Kconfig"), kconfig_emul_content)
-    write_file(os.path.join(emul_path, f"{module_name}.c"), c_content)
-    write_file(os.path.join(emul_path, f"{module_name}.h"), h_content)
-
-    # Write DTS YAML file with your filename rule
+    changes.append(write_file(fs, os.path.join(emul_path, "CMakeLists.txt"), cmake_emul_content))
+    changes.append(write_file(fs, os.path.join(emul_path, "Kconfig"), kconfig_emul_content))
+    changes.append(write_file(fs, os.path.join(emul_path, f"{module_name}.c"), c_content))
+    changes.append(write_file(fs, os.path.join(emul_path, f"{module_name}.h"), h_content))
+    for filename, content in parts["files"].items():
+        changes.append(write_file(fs, os.path.join(emul_path, filename), content))
+
+    # Write the driver's ztest app (tests + latency benchmarks)
+    tests_path = os.path.join(module_path, "tests", module_name)
+    for relpath, content in ztest_files(module_name, interface, trigger=trigger, pm=pm).items():
+        changes.append(write_file(fs, os.path.join(tests_path, relpath), content))
+
+    # Write DTS YAML file, named after the compatible it declares
     yaml_path = os.path.join(module_path, "dts", "bindings", category)
-    parts = module_name.split('_', 1)
-    if len(parts) == 2:
-        first_part = parts[0]
-        rest = parts[1].replace('_', '-')
-        yaml_filename = f"{first_part},{rest}.yaml"
-    else:
-        yaml_filename = f"{module_name}.yaml"
+    compat = compatible_of(module_name)
+    yaml_filename = f"{compat}.yaml"
 
     # dts yaml content
     dts_yaml_content = f"""\
 description: Emulator for {module_name}
 
-compatible: "{yaml_filename}"
+compatible: "{compat}"
 
 include: [sensor-device.yaml, {interface}-device.yaml]
-"""
+{parts["binding"]}"""
 
 
-    write_file(os.path.join(yaml_path, yaml_filename), dts_yaml_content)
+    changes.append(write_file(fs, os.path.join(yaml_path, yaml_filename), dts_yaml_content))
 
     # Write zephyr module.yaml
-    write_file(os.path.join(module_path, "zephyr", "module.yaml"), zephyr_module_yaml_content)
-
+    if not aggregate:
+        changes.append(write_file(fs, os.path.join(module_path, "zephyr", "module.yaml"), zephyr_module_yaml_content))
+
+    return changes
+
+def add_driver(module_name, interface, address, category="sensor", output=".", fs=None, **options):
+    fs = fs or DiskFS()
+    telemetry = options.pop("telemetry", False)  # app side only, the driver is unchanged
+    reduce = options.pop("reduce", None)
+    changes = create_structure(output, module_name, interface, category, fs=fs, **options)
+    if any(change.action == "error" for change in changes):
+        return changes
+    changes += update_root_cmakelists(output, options.get("aggregate") or module_name, fs=fs)
+    pm = options.get("pm", False)
+    extra = (("PM_DEVICE", "PM_DEVICE_RUNTIME") if pm else ()) + (("SERIAL",) if telemetry else ())
+    changes += update_root_prjconf(module_name, fs=fs, extra=extra)
+    changes += update_native_sim_overlay(module_name, address, fs=fs, int_gpio=options.get("trigger", False))
+    if telemetry:
+        changes += update_telemetry(fs=fs)
+    changes += update_main_c(module_name, fs=fs, trigger=options.get("trigger", False), pm=pm, telemetry=telemetry,
+                             reduce=reduce)
+    return changes
 
 def main():
     parser = argparse.ArgumentParser(description="Create Zephyr driver module structure.")
@@ -840,14 +2388,39 @@ def main():
     parser.add_argument("-a", "--address", required=True, help="Address at interface node")
     parser.add_argument("-c", "--category", default="sensor", help="Interface type, e.g., i2c, spi")
     parser.add_argument("-o", "--output", default=".", help="Base output directory (default current directory)")
+    parser.add_argument("-t", "--trace", default=None, help="CSV or .bin (uint16 LE) capture replayed by sample_fetch")
+    parser.add_argument("--trace-column", type=int, default=0, help="CSV column holding the raw samples (default 0)")
+    parser.add_argument("--trace-inline-max", type=int, default=4096, help="Max samples compiled into the image; larger traces are streamed on native_sim (default 4096)")
+    parser.add_argument("--calibration", default=None, help="Calibration curve for raw_to_unit: 'poly:c0,c1,...' or CSV of raw,unit points (needs numpy)")
+    parser.add_argument("--calibration-bits", type=int, default=8, help="Lookup table segments as a power of two, interpolated linearly (default 8 -> 256 segments)")
+    parser.add_argument("--bus-timing", action="store_true", help="Charge simulated I2C transfer time at the bus clock-frequency")
+    parser.add_argument("--trigger", action="store_true", help="Data-ready trigger on an emulated int-gpios line; main.c gets a handler instead of a polling thread")
+    parser.add_argument("--pm", action="store_true", help="Device runtime PM with modelled power-on latency; main.c powers the device only around each fetch")
+    parser.add_argument("--shm", action="store_true", help="Read host-injected values and waveforms from a shared mmap region on native_sim; drive it with zephyr_shm.py")
+    parser.add_argument("--telemetry", action="store_true", help="Stream samples as binary frames on uart1 (src/telemetry.c) instead of LOG_INF; decode with zephyr_telemetry.py")
+    parser.add_argument("--reduce", default=None, help="Output stage in main.c: 'decimate:N', 'window:N' (mean/min/max) or 'deadband:D' (units)")
+    parser.add_argument("--aggregate", nargs="?", const="emul_drivers", default=None, help="Put the driver in one shared module (default name emul_drivers) instead of a module per driver")
 
     args = parser.parse_args()
 
-    create_structure(args.output, args.module_name, args.interface, args.category)
-    update_root_cmakelists(args.output, args.module_name)
-    update_root_prjconf(args.module_name)
-    update_native_sim_overlay(args.module_name, args.address)
-    update_main_c(args.module_name)
+    options = dict(
+        trace=args.trace,
+        trace_column=args.trace_column,
+        trace_inline_max=args.trace_inline_max,
+        calibration=args.calibration,
+        calibration_bits=args.calibration_bits,
+        bus_timing=args.bus_timing,
+        trigger=args.trigger,
+        pm=args.pm,
+        shm=args.shm,
+        telemetry=args.telemetry,
+        reduce=args.reduce,
+        aggregate=args.aggregate,
+    )
+    for change in add_driver(args.module_name, args.interface, args.address, args.category, args.output, **options):
+        print(change)
+        if change.diff:
+            print(change.diff)
 
 if __name__ == "__main__":
     main()
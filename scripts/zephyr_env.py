@@ -3,20 +3,32 @@ import argparse
 import re
 from colorama import init, Fore
 
+from zephyr_fs import Change, DiskFS
+
 init(autoreset=True)
 
+I2C_BITRATES = {
+    "standard": ("I2C_BITRATE_STANDARD", "100kHz"),
+    "fast": ("I2C_BITRATE_FAST", "400kHz"),
+    "fast-plus": ("I2C_BITRATE_FAST_PLUS", "1MHz"),
+}
+
+COLORS = {
+    "created": Fore.GREEN,
+    "skipped": Fore.YELLOW,
+    "error": Fore.RED,
+}
+
 def validate_cmake_version(version):
     if not re.match(r"^\d+\.\d+(\.\d+)?$", version):
         raise ValueError("Invalid CMake version format. Use something like '3.20.0'")
     return version
 
-def write_file(path, content, overwrite=False):
-    if os.path.exists(path) and not overwrite:
-        print(Fore.YELLOW + f"Skipped existing: {path}")
-        return
-    with open(path, "w") as f:
-        f.write(content)
-    print(Fore.GREEN + f"Generated: {path}")
+def write_file(fs, path, content, overwrite=False):
+    if fs.exists(path) and not overwrite:
+        return Change(path, "skipped", f"Skipped existing: {path}")
+    fs.write(path, content)
+    return Change(path, "created", f"Generated: {path}")
 
 def generate_project(
     project_name,
@@ -25,8 +37,11 @@ def generate_project(
     output_folder,
     board,
     overlay,
-    overwrite=False
+    overwrite=False,
+    fs=None,
+    i2c_speed="standard",
 ):
+    fs = fs or DiskFS()
     cmake_version = cmake_version or "3.20.0"
     language = language or "C"
     board = board or "qemu_riscv64"
@@ -35,15 +50,22 @@ def generate_project(
     try:
         validate_cmake_version(cmake_version)
     except ValueError as e:
-        print(Fore.RED + str(e))
-        return
+        return [Change(output_folder, "error", str(e))]
+
+    if i2c_speed not in I2C_BITRATES:
+        return [Change(output_folder, "error", f"Invalid I2C speed '{i2c_speed}'. Use one of: {', '.join(I2C_BITRATES)}")]
+    i2c_bitrate, i2c_freq = I2C_BITRATES[i2c_speed]
 
-    os.makedirs(output_folder, exist_ok=True)
+    changes = []
+    fs.makedirs(output_folder)
 
     # CMakeLists.txt
     cmake_content = f"""# Minimum CMake version required
 cmake_minimum_required(VERSION {cmake_version})
 
+# Faster builds with many emulated drivers (make PCH=1)
+option(EMUL_PCH "Precompile the Zephyr headers shared by the emulated drivers" OFF)
+
 # Include Zephyr
 find_package(Zephyr REQUIRED HINTS $ENV{{ZEPHYR_BASE}})
 
@@ -59,7 +81,7 @@ project(
 target_sources(app PRIVATE src/main.c)
 
 """
-    write_file(os.path.join(output_folder, "CMakeLists.txt"), cmake_content, overwrite)
+    changes.append(write_file(fs, os.path.join(output_folder, "CMakeLists.txt"), cmake_content, overwrite))
     # prj.conf
     prj_conf_content = f"""# Emul
 CONFIG_EMUL=y
@@ -90,48 +112,75 @@ CONFIG_CBPRINTF_FP_SUPPORT=y
 CONFIG_LOG=y
 #CONFIG_LOG_DEFAULT_LEVEL=4
 """
-    write_file(os.path.join(output_folder, "prj.conf"), prj_conf_content, overwrite)
+    changes.append(write_file(fs, os.path.join(output_folder, "prj.conf"), prj_conf_content, overwrite))
+
+    # profile.conf (extra config used by 'make profile')
+    profile_conf_content = """\
+# Tracing (CTF to a host file on native_sim, see -trace-file)
+CONFIG_TRACING=y
+CONFIG_TRACING_CTF=y
+CONFIG_TRACING_BACKEND_POSIX=y
+
+# Thread analyzer
+CONFIG_THREAD_NAME=y
+CONFIG_THREAD_ANALYZER=y
+CONFIG_THREAD_ANALYZER_USE_LOG=y
+CONFIG_THREAD_ANALYZER_AUTO=y
+CONFIG_THREAD_ANALYZER_AUTO_INTERVAL=5
+CONFIG_THREAD_RUNTIME_STATS=y
+"""
+    changes.append(write_file(fs, os.path.join(output_folder, "profile.conf"), profile_conf_content, overwrite))
+
+    # stack.conf (extra config used by 'make stack-tune', no tracing so usage is not inflated)
+    stack_conf_content = """\
+CONFIG_THREAD_NAME=y
+CONFIG_THREAD_ANALYZER=y
+CONFIG_THREAD_ANALYZER_USE_LOG=y
+CONFIG_THREAD_ANALYZER_AUTO=y
+CONFIG_THREAD_ANALYZER_AUTO_INTERVAL=2
+"""
+    changes.append(write_file(fs, os.path.join(output_folder, "stack.conf"), stack_conf_content, overwrite))
 
 
     # Overlay files
     boards_dir = os.path.join(output_folder, "boards")
-    os.makedirs(boards_dir, exist_ok=True)
+    fs.makedirs(boards_dir)
 
-    native_sim_overlay_content = """&i2c0 {
+    native_sim_overlay_content = f"""&i2c0 {{
     status = "okay";
-    clock-frequency = <I2C_BITRATE_STANDARD>; /* 100kHz */
-};
+    clock-frequency = <{i2c_bitrate}>; /* {i2c_freq} */
+}};
 
-&gpio0 {
+&gpio0 {{
     status = "okay";
-};
+}};
 
-&led0 {
+&led0 {{
     status = "okay";
-};
+}};
 """
-    write_file(os.path.join(output_folder, "boards/native_sim.overlay"), native_sim_overlay_content, overwrite)
+    changes.append(write_file(fs, os.path.join(output_folder, "boards/native_sim.overlay"), native_sim_overlay_content, overwrite))
 
-    esp32s3_devkitc_content = """&i2c0 {
+    esp32s3_devkitc_content = f"""&i2c0 {{
     status = "okay";
-    clock-frequency = <I2C_BITRATE_STANDARD>; /* 100kHz */
-};
+    clock-frequency = <{i2c_bitrate}>; /* {i2c_freq} */
+}};
 
-/ {
-	  aliases {
+/ {{
+	  aliases {{
         led0 = &led0;
-	  };
+	  }};
 
 
-    leds {
+    leds {{
         compatible = "gpio-leds";
-        led0: led_0 {
+        led0: led_0 {{
             gpios = <&fakegpio 0 GPIO_ACTIVE_HIGH>;
             label = "FAKE_LED_0";
-        };
-    };
+        }};
+    }};
 
-    fakegpio: gpio@0 {
+    fakegpio: gpio@0 {{
         compatible = "zephyr,gpio-emul";
         gpio-controller;
         #gpio-cells = <2>;
@@ -140,39 +189,88 @@ CONFIG_LOG=y
         #size-cells = <1>;
         ngpios = <32>;
         status = "okay";
-    };
-};
+    }};
+}};
 """
-    write_file(os.path.join(output_folder, "boards/esp32s3_devkitc.overlay"), esp32s3_devkitc_content, overwrite)
+    changes.append(write_file(fs, os.path.join(output_folder, "boards/esp32s3_devkitc.overlay"), esp32s3_devkitc_content, overwrite))
 
     util_dir = os.path.join(output_folder, "utils")
-    os.makedirs(util_dir, exist_ok=True)
+    fs.makedirs(util_dir)
     qemu_content = """\
 dd if=/dev/zero of=build/zephyr/zephyr_4mb.bin bs=1M count=4
 dd if=build/zephyr/zephyr.bin of=build/zephyr/zephyr_4mb.bin conv=notrunc
 qemu-system-xtensa -nographic -machine esp32s3 -drive file=build/zephyr/zephyr_4mb.bin,if=mtd,format=raw
 """
-    write_file(os.path.join(output_folder, "utils/qemu_esp32.sh"), qemu_content, overwrite)
+    changes.append(write_file(fs, os.path.join(output_folder, "utils/qemu_esp32.sh"), qemu_content, overwrite))
 
     # Makefile
     makefile_content = f"""\
 DRIVER  ?= sensirion_sht3xd_emul
 ITF     ?= i2c
 ADD     ?= 44
+TRACE   ?=
+CAL     ?=
+BUS_TIMING ?=
+TRIGGER ?=
+PM      ?=
+TELEMETRY ?=
+REDUCE  ?=
+SHM     ?=
+AGGREGATE ?=
+# Several drivers at once, as <driver>@<addr> (ITF and the options above apply to all): make -j add-drivers
+DRIVERS ?=
+
+PROFILE_SECONDS ?= 10
+STACK_SECONDS ?= 10
+STACK_MARGIN ?= 25
+TELEMETRY_SECONDS ?= 10
+
+# ztest app generated next to each driver (see create_structure)
+TEST_DIR := ../modules/$(or $(AGGREGATE),$(DRIVER))/tests/$(DRIVER)
 
 BOARD   ?= {board}
 OVERLAY ?= {overlay}
 
+# Build speed with many drivers: PCH=1 precompiles the Zephyr headers they share
+PCH     ?=
+EMUL_BUILD_OPTS := -DEMUL_PCH=$(if $(PCH),ON,OFF)
+
 ORANGE  :=\\033[38;5;214m
 RESET   :=\\033[0m
 
+# Reconfigure only when board, overlay, PCH, prj.conf or ZEPHYR_EXTRA_MODULES change
+CONFIG_STAMP := build/.config-stamp
+CONFIG_HASH  := $(shell {{ echo "$(BOARD) $(OVERLAY) $(EMUL_BUILD_OPTS)"; cat boards/$(OVERLAY).overlay prj.conf; sed -n '/^set(ZEPHYR_EXTRA_MODULES/,/)/p' CMakeLists.txt; }} 2>/dev/null | cksum | cut -d' ' -f1)
+CONFIG_KEY   := $(BOARD) $(CONFIG_HASH)
+
+.PHONY: all add-driver add-drivers watch validate config menuconfig build run profile stack-tune telemetry test clean west-build west-run help
+
 all: config build run
 
+DRIVER_OPTS = $(if $(TRACE),-t $(TRACE)) $(if $(CAL),--calibration $(CAL)) $(if $(BUS_TIMING),--bus-timing) $(if $(TRIGGER),--trigger) $(if $(PM),--pm) $(if $(SHM),--shm) $(if $(TELEMETRY),--telemetry) $(if $(REDUCE),--reduce $(REDUCE)) $(if $(AGGREGATE),--aggregate $(AGGREGATE))
+
 add-driver:
-\tpython3 ../scripts/zephyr_driver_emul.py -m $(DRIVER) -i $(ITF) -a $(ADD) -o ../modules
+\tpython3 ../scripts/zephyr_driver_emul.py -m $(DRIVER) -i $(ITF) -a $(ADD) -o ../modules $(DRIVER_OPTS)
+
+# One target per driver so make -j runs them in parallel; shared files are locked by the generator
+add-drivers: $(addprefix add-driver@,$(DRIVERS))
+
+add-driver@%:
+\tpython3 ../scripts/zephyr_driver_emul.py -m $(word 1,$(subst @, ,$*)) -i $(ITF) -a $(word 2,$(subst @, ,$*)) -o ../modules $(DRIVER_OPTS)
 
-config:
-\tcmake -S . -B build -DBOARD=$(BOARD) -DDTC_OVERLAY_FILE=boards/$(OVERLAY).overlay
+watch:
+\tpython3 ../scripts/zephyr_watch.py -o ../modules
+
+validate:
+\t@python3 ../scripts/zephyr_validate.py
+
+config: validate
+\t@if [ -f build/build.ninja ] && [ "$$(cat $(CONFIG_STAMP) 2>/dev/null)" = "$(CONFIG_KEY)" ]; then \\
+\t\techo "Configuration unchanged, skipping CMake"; \\
+\telse \\
+\t\tif [ -f build/CMakeCache.txt ] && {{ [ ! -f build/build.ninja ] || [ "$$(cut -d' ' -f1 $(CONFIG_STAMP) 2>/dev/null)" != "$(BOARD)" ]; }}; then rm -rf build; fi; \\
+\t\tcmake -G Ninja -S . -B build -DBOARD=$(BOARD) -DDTC_OVERLAY_FILE=boards/$(OVERLAY).overlay $(EMUL_BUILD_OPTS) && echo "$(CONFIG_KEY)" > $(CONFIG_STAMP); \\
+\tfi
 
 menuconfig: config
 \tcmake --build build --target menuconfig
@@ -183,11 +281,30 @@ build:
 run:
 \tcmake --build build --target run
 
+profile:
+\tcmake -G Ninja -S . -B build-profile -DBOARD=$(BOARD) -DDTC_OVERLAY_FILE=boards/$(OVERLAY).overlay $(EMUL_BUILD_OPTS) -DEXTRA_CONF_FILE=profile.conf
+\tcmake --build build-profile
+\t./build-profile/zephyr/zephyr.exe -stop_at=$(PROFILE_SECONDS) -trace-file=build-profile/trace.ctf | tee build-profile/profile.log
+\tpython3 ../scripts/zephyr_profile.py build-profile/trace.ctf -o build-profile/profile.json
+
+stack-tune:
+\tcmake -G Ninja -S . -B build-stack -DBOARD=$(BOARD) -DDTC_OVERLAY_FILE=boards/$(OVERLAY).overlay $(EMUL_BUILD_OPTS) -DEXTRA_CONF_FILE=stack.conf
+\tcmake --build build-stack
+\tpython3 ../scripts/zephyr_stack_tune.py -b build-stack -t $(STACK_SECONDS) -m $(STACK_MARGIN)
+
+telemetry: config build
+\tpython3 ../scripts/zephyr_telemetry.py --run build/zephyr/zephyr.exe -t $(TELEMETRY_SECONDS) -n src/main.c -o build/telemetry.npy
+
+test:
+\tcmake -G Ninja -S $(TEST_DIR) -B build-test -DBOARD=native_sim
+\tcmake --build build-test
+\t./build-test/zephyr/zephyr.exe
+
 clean:
-\trm -rf build
+\trm -rf build build-profile build-stack build-test
 
 west-build:
-\twest build -p always -b $(BOARD) -- -DDTC_OVERLAY_FILE=boards/$(OVERLAY).overlay
+\twest build -p always -b $(BOARD) -- -DDTC_OVERLAY_FILE=boards/$(OVERLAY).overlay $(EMUL_BUILD_OPTS)
 
 west-run:
 \twest build -t run
@@ -197,21 +314,28 @@ help:
 \t@echo "Makefile targets:"
 \t@echo ""
 \t@echo "all         Run config, build, and run"
-\t@echo "config      Configure the build with CMake"
+\t@echo "add-drivers Add every DRIVERS entry (<driver>@<addr>), in parallel with make -j"
+\t@echo "validate    Check overlay, bindings, Kconfig and sources for mismatches"
+\t@echo "config      Validate, then configure the build with CMake"
 \t@echo "menuconfig  Run menuconfig (interactive config)"
 \t@echo "build       Build using CMake"
 \t@echo "run         Run using CMake"
 \t@echo "west-build  Build using west (recommended)"
 \t@echo "west-run    Run using west (if supported)"
-\t@echo "clean       Remove build directory"
+\t@echo "profile     Trace a native_sim run and report per-thread CPU and latency"
+\t@echo "stack-tune  Measure peak stack usage and resize each thread stack in main.c"
+\t@echo "telemetry   Run native_sim and decode the binary sample stream from uart1"
+\t@echo "test        Build and run the driver ztest app, with BENCH latency lines"
+\t@echo "clean       Remove build directories"
+\t@echo "watch       Regenerate, rebuild and run on every change"
 \t@echo "help        Show this help message"
 \t@echo "$(RESET)"
 """
-    write_file(os.path.join(output_folder, "Makefile"), makefile_content, overwrite)
+    changes.append(write_file(fs, os.path.join(output_folder, "Makefile"), makefile_content, overwrite))
 
     # main.c
     src_dir = os.path.join(output_folder, "src")
-    os.makedirs(src_dir, exist_ok=True)
+    fs.makedirs(src_dir)
     main_c_content = """\
 // Kernel and driver includes
 
@@ -221,11 +345,19 @@ help:
 #include <zephyr/drivers/gpio.h>
 #include <zephyr/logging/log.h>
 
+#ifdef CONFIG_TRACING_CTF
+#include <zephyr/tracing/tracing.h>
+#define TRACE_MARK(name, arg) sys_trace_named_event(name, arg, 0)
+#else
+#define TRACE_MARK(name, arg)
+#endif
+
 LOG_MODULE_REGISTER(main, LOG_LEVEL_INF);
 
 // Constants and thread configuration
 
 #define STACK_SIZE 1024
+#define LED_STACK_SIZE STACK_SIZE
 #define LED_PRIORITY 5
 #define LED_BLINK_INTERVAL_MS 500
 
@@ -236,7 +368,7 @@ static const struct gpio_dt_spec led = GPIO_DT_SPEC_GET(LED0_NODE, gpios);
 
 // Thread stack and control block
 
-K_THREAD_STACK_DEFINE(led_stack, STACK_SIZE);
+K_THREAD_STACK_DEFINE(led_stack, LED_STACK_SIZE);
 static struct k_thread led_thread_data;
 
 // LED Thread
@@ -271,15 +403,18 @@ int main(void)
 
     LOG_INF("LED ready. Launching thread...");
 
-    k_thread_create(&led_thread_data, led_stack, STACK_SIZE,
+    k_thread_create(&led_thread_data, led_stack, LED_STACK_SIZE,
                     led_thread, NULL, NULL, NULL,
                     LED_PRIORITY, 0, K_NO_WAIT);
+    k_thread_name_set(&led_thread_data, "led_thread");
 
     return 0;
 }
 """
 
-    write_file(os.path.join(src_dir, "main.c"), main_c_content, overwrite)
+    changes.append(write_file(fs, os.path.join(src_dir, "main.c"), main_c_content, overwrite))
+
+    return changes
 
 def main():
     parser = argparse.ArgumentParser(description="Generate a boilerplate Zephyr project structure.")
@@ -289,11 +424,12 @@ def main():
     parser.add_argument("-o", "--output_folder", default=".", help="Output folder (default: current directory)")
     parser.add_argument("-b", "--board", default="qemu_riscv64", help="Target board (default: qemu_riscv64)")
     parser.add_argument("-y", "--overlay", default="app", help="Overlay file name (default: app)")
+    parser.add_argument("-s", "--i2c_speed", default="standard", choices=list(I2C_BITRATES), help="I2C bus speed in the overlays (default: standard)")
     parser.add_argument("--overwrite", action="store_true", help="Overwrite existing files")
 
     args = parser.parse_args()
 
-    generate_project(
+    changes = generate_project(
         project_name=args.project_name,
         cmake_version=args.c_make_version,
         language=args.languages,
@@ -301,7 +437,10 @@ def main():
         board=args.board,
         overlay=args.overlay,
         overwrite=args.overwrite,
+        i2c_speed=args.i2c_speed,
     )
+    for change in changes:
+        print(COLORS.get(change.action, "") + str(change))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,148 @@
+import os
+import fcntl
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+
+@dataclass
+class Change:
+    path: str
+    action: str          # 'created' | 'updated' | 'unchanged' | 'skipped' | 'warning' | 'error'
+    message: str = ""
+    diff: str = ""
+
+    def __str__(self):
+        return self.message or f"{self.action}: {self.path}"
+
+
+class DiskFS:
+    """Filesystem backend rooted at a directory on disk."""
+
+    def __init__(self, root="."):
+        self.root = root
+
+    def _path(self, path):
+        return os.path.join(self.root, path)
+
+    def at(self, path):
+        return DiskFS(self._path(path))
+
+    def exists(self, path):
+        return os.path.exists(self._path(path))
+
+    def isfile(self, path):
+        return os.path.isfile(self._path(path))
+
+    def makedirs(self, path):
+        if path:
+            os.makedirs(self._path(path), exist_ok=True)
+
+    def list_files(self, path=""):
+        # Every file below path, as paths usable with this filesystem
+        found = []
+        for dirpath, _, filenames in os.walk(self._path(path)):
+            rel = os.path.relpath(dirpath, self.root)
+            found += [os.path.normpath(os.path.join(rel, f)) for f in filenames]
+        return sorted(found)
+
+    def read(self, path):
+        with open(self._path(path), "r", encoding="utf-8") as f:
+            return f.read()
+
+    def write(self, path, content):
+        # Temp file + rename: readers and concurrent writers never see a partial file
+        self.makedirs(os.path.dirname(path))
+        target = self._path(path)
+        directory, name = os.path.split(target)
+        tmp = os.path.join(directory, f".{name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        data = content if isinstance(content, bytes) else content.encode("utf-8")
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            if os.path.exists(target):
+                os.chmod(tmp, os.stat(target).st_mode & 0o7777)
+            os.replace(tmp, target)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    @contextmanager
+    def lock(self, path):
+        # Exclusive flock on the directory holding path, held across a read-modify-write.
+        # Files are replaced by rename, so the directory is the stable thing to lock.
+        directory = os.path.dirname(path)
+        self.makedirs(directory)
+        fd = os.open(self._path(directory) if directory else self.root, os.O_RDONLY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)  # releases the flock
+
+
+class MemoryFS:
+    """In-memory filesystem backend: files are kept in a {path: content} dict."""
+
+    def __init__(self, files=None, root=""):
+        self.files = {}
+        self.dirs = set()
+        self.root = root
+        self.locks = {}
+        self.locks_guard = threading.Lock()
+        for path, content in (files or {}).items():
+            self.write(path, content)
+
+    def _key(self, path):
+        return os.path.normpath(os.path.join(self.root, path))
+
+    def at(self, path):
+        # A view on a subdirectory that shares storage with this filesystem
+        view = MemoryFS(root=os.path.join(self.root, path))
+        view.files = self.files
+        view.dirs = self.dirs
+        view.locks = self.locks
+        view.locks_guard = self.locks_guard
+        return view
+
+    def exists(self, path):
+        key = self._key(path)
+        return key in self.files or key in self.dirs
+
+    def isfile(self, path):
+        return self._key(path) in self.files
+
+    def _add_dirs(self, key):
+        while key and key not in (".", "..", os.sep):
+            self.dirs.add(key)
+            key = os.path.dirname(key)
+
+    def makedirs(self, path):
+        self._add_dirs(self._key(path))
+
+    def list_files(self, path=""):
+        prefix = self._key(path)
+        found = [k for k in self.files if prefix in (".", k) or k.startswith(prefix + os.sep)]
+        return sorted(os.path.relpath(k, self.root or ".") for k in found)
+
+    def read(self, path):
+        try:
+            return self.files[self._key(path)]
+        except KeyError:
+            raise FileNotFoundError(path) from None
+
+    def write(self, path, content):
+        key = self._key(path)
+        self.files[key] = content
+        self._add_dirs(os.path.dirname(key))
+
+    @contextmanager
+    def lock(self, path):
+        # Same granularity as DiskFS.lock: one lock per directory, shared by every view
+        key = os.path.dirname(self._key(path))
+        with self.locks_guard:
+            lock = self.locks.setdefault(key, threading.RLock())
+        with lock:
+            yield
@@ -0,0 +1,192 @@
+import os
+import re
+import json
+import argparse
+from collections import defaultdict
+
+# Named events emitted by the generated sampling loops (see update_main_c)
+FETCH_EVENT = "fetch"
+LOGGED_EVENT = "logged"
+
+TYPEALIAS_RE = re.compile(r"typealias\s+integer\s*\{([^}]*)\}\s*:=\s*(\w+)\s*;")
+ENUM_RE = re.compile(r"enum\s+(\w+)\s*:\s*(\w+)\s*\{")
+HEADER_RE = re.compile(r"event\.header\s*:=\s*struct\s*\{(.*?)\}\s*;", re.S)
+EVENT_RE = re.compile(
+    r"event\s*\{\s*name\s*=\s*\"?(\w+)\"?\s*;\s*id\s*=\s*(\w+)\s*;\s*fields\s*:=\s*struct\s*\{(.*?)\}\s*;",
+    re.S,
+)
+FIELD_RE = re.compile(r"((?:enum\s+)?\w+)\s+(\w+)(?:\s*\[\s*(\d+)\s*\])?\s*;")
+CLOCK_FREQ_RE = re.compile(r"clock\s*\{[^}]*freq\s*=\s*(\d+)", re.S)
+BYTE_ORDER_RE = re.compile(r"trace\s*\{[^}]*byte_order\s*=\s*(\w+)", re.S)
+
+
+class Metadata:
+    """Event layouts read from Zephyr's CTF TSDL metadata file."""
+
+    def __init__(self, text):
+        self.types = {}
+        for body, name in TYPEALIAS_RE.findall(text):
+            props = dict(re.findall(r"(\w+)\s*=\s*(\w+)", body))
+            self.types[name] = (int(props["size"]) // 8, props.get("signed") == "true", "encoding" in props)
+        for name, base in ENUM_RE.findall(text):
+            self.types[f"enum {name}"] = self.types[base]
+
+        m = BYTE_ORDER_RE.search(text)
+        self.endian = ">" if m and m.group(1) == "be" else "<"
+        m = CLOCK_FREQ_RE.search(text)
+        self.clock_hz = int(m.group(1)) if m else 1_000_000_000
+
+        m = HEADER_RE.search(text)
+        if not m:
+            raise ValueError("Metadata has no stream event.header")
+        self.header = self._fields(m.group(1))
+
+        self.events = {}
+        for name, event_id, body in EVENT_RE.findall(text):
+            self.events[int(event_id, 0)] = (name, self._fields(body))
+
+    def _fields(self, body):
+        fields = []
+        for type_name, name, count in FIELD_RE.findall(body):
+            type_name = " ".join(type_name.split())
+            if type_name not in self.types:
+                raise ValueError(f"Unknown CTF type '{type_name}'")
+            fields.append((name, self.types[type_name], int(count) if count else None))
+        return fields
+
+    def _read(self, buf, pos, fields):
+        values = {}
+        for name, (size, signed, is_text), count in fields:
+            n = count or 1
+            end = pos + size * n
+            if end > len(buf):
+                raise EOFError
+            if is_text:
+                values[name] = buf[pos:end].split(b"\0", 1)[0].decode("ascii", "replace")
+            elif count:
+                values[name] = list(buf[pos:end])
+            else:
+                values[name] = int.from_bytes(buf[pos:end], "little" if self.endian == "<" else "big", signed=signed)
+            pos = end
+        return values, pos
+
+    def decode(self, buf):
+        # Yield (timestamp, name, fields) until the stream ends or is truncated
+        ts_field = next(f for f in self.header if f[0] == "timestamp")
+        ts_wrap = 1 << (8 * ts_field[1][0])
+        last_raw, epoch, pos = None, 0, 0
+        while pos < len(buf):
+            try:
+                header, pos = self._read(buf, pos, self.header)
+                if header["id"] not in self.events:
+                    raise ValueError(f"Unknown event id 0x{header['id']:x} at offset {pos}")
+                name, fields = self.events[header["id"]]
+                values, pos = self._read(buf, pos, fields)
+            except EOFError:
+                return
+            raw = header["timestamp"]
+            if last_raw is not None and raw < last_raw:
+                epoch += ts_wrap  # counter wrapped
+            last_raw = raw
+            yield (epoch + raw) * 1_000_000 // self.clock_hz, name, values
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+def histogram(values_us):
+    # Power-of-two buckets: [0,1) [1,2) [2,4) ... microseconds
+    buckets = defaultdict(int)
+    for v in values_us:
+        buckets[0 if v < 1 else 1 << (int(v).bit_length() - 1)] += 1
+    return {f"{lo}-{max(1, lo * 2)}us": buckets[lo] for lo in sorted(buckets)}
+
+def analyze(events):
+    busy = defaultdict(int)            # thread -> us on CPU
+    gaps = defaultdict(list)           # thread -> us between switch-out and next switch-in
+    switched_out_at = {}
+    pending_fetch = {}
+    latencies = defaultdict(list)      # thread -> sample-to-log latency (us)
+
+    current, since, first, last = None, None, None, None
+    for ts, name, fields in events:
+        first = ts if first is None else first
+        last = ts
+        if name in ("thread_switched_in", "thread_switched_out"):
+            thread = fields.get("name") or f"0x{fields.get('thread_id', 0):x}"
+            if current is not None:
+                busy[current] += ts - since
+            if name == "thread_switched_in":
+                if thread in switched_out_at:
+                    gaps[thread].append(ts - switched_out_at.pop(thread))
+                current, since = thread, ts
+            else:
+                switched_out_at[thread] = ts
+                current, since = None, None
+        elif name == "named_event" and current is not None:
+            key = (current, fields.get("arg0"))
+            if fields.get("name") == FETCH_EVENT:
+                pending_fetch[key] = ts
+            elif fields.get("name") == LOGGED_EVENT and key in pending_fetch:
+                latencies[current].append(ts - pending_fetch.pop(key))
+    if current is not None:
+        busy[current] += last - since
+
+    total = max(1, (last or 0) - (first or 0))
+    threads = {}
+    for thread in sorted(set(busy) | set(gaps) | set(latencies)):
+        g, lat = gaps[thread], latencies[thread]
+        threads[thread] = {
+            "cpu_us": busy[thread],
+            "cpu_share": round(100.0 * busy[thread] / total, 2),
+            "gaps": {"count": len(g), "mean_us": round(sum(g) / len(g), 1) if g else 0,
+                     "p99_us": percentile(g, 99), "max_us": max(g, default=0)},
+            "latency": {"count": len(lat), "mean_us": round(sum(lat) / len(lat), 1) if lat else 0,
+                        "p99_us": percentile(lat, 99), "max_us": max(lat, default=0),
+                        "histogram": histogram(lat)},
+        }
+    return {"duration_us": total, "threads": threads}
+
+def format_report(report):
+    lines = [f"Trace duration: {report['duration_us'] / 1000:.1f} ms", ""]
+    lines.append(f"{'thread':<28} {'cpu %':>7} {'gaps':>6} {'gap mean':>9} {'gap max':>9} {'lat p99':>9}")
+    ranked = sorted(report["threads"].items(), key=lambda kv: -kv[1]["cpu_us"])
+    for thread, t in ranked:
+        lat = f"{t['latency']['p99_us']}us" if t["latency"]["count"] else "-"
+        lines.append(f"{thread:<28} {t['cpu_share']:>7.2f} {t['gaps']['count']:>6} "
+                     f"{t['gaps']['mean_us']:>7.1f}us {t['gaps']['max_us']:>7}us {lat:>9}")
+    for thread, t in ranked:
+        if not t["latency"]["count"]:
+            continue
+        lines += ["", f"{thread}: sample-to-log latency ({t['latency']['count']} samples, mean {t['latency']['mean_us']}us)"]
+        peak = max(t["latency"]["histogram"].values())
+        for bucket, count in t["latency"]["histogram"].items():
+            lines.append(f"  {bucket:>14} {count:>7} {'#' * max(1, 40 * count // peak)}")
+    return "\n".join(lines)
+
+def main():
+    default_metadata = os.path.join(os.environ.get("ZEPHYR_BASE", ""), "subsys/tracing/ctf/tsdl/metadata")
+
+    parser = argparse.ArgumentParser(description="Per-thread CPU share, scheduling gaps and sample latency from a Zephyr CTF trace.")
+    parser.add_argument("trace", help="CTF stream written by native_sim (-trace-file=...)")
+    parser.add_argument("-m", "--metadata", default=default_metadata, help="CTF TSDL metadata (default $ZEPHYR_BASE/subsys/tracing/ctf/tsdl/metadata)")
+    parser.add_argument("-j", "--json", action="store_true", help="Print the report as JSON")
+    parser.add_argument("-o", "--output", default=None, help="Also write the JSON report to this file")
+
+    args = parser.parse_args()
+
+    with open(args.metadata, "r", encoding="utf-8") as f:
+        metadata = Metadata(f.read())
+    with open(args.trace, "rb") as f:
+        report = analyze(metadata.decode(f.read()))
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2) if args.json else format_report(report))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+import os
+import sys
+import mmap
+import time
+import struct
+import argparse
+from array import array
+
+# Layout of the region a driver generated with --shm maps on native_sim (see shm_parts)
+MAGIC = 0x48534D45
+VERSION = 1
+HEADER = struct.Struct("<IHHII")    # magic, version, slots, capacity, slot_size
+SLOT = struct.Struct("<IIIIHH")     # mode, len, head, tail, value, reserved
+
+MODE_OFF, MODE_VALUE, MODE_LOOP, MODE_STREAM = range(4)
+MODE_NAMES = {MODE_OFF: "off", MODE_VALUE: "value", MODE_LOOP: "loop", MODE_STREAM: "stream"}
+
+
+def as_samples(samples):
+    # uint16 little endian bytes from a list, an array('H') or a numpy array
+    if hasattr(samples, "astype"):
+        return samples.astype("<u2").tobytes()
+    data = samples if isinstance(samples, array) and samples.typecode == "H" else array("H", samples)
+    if sys.byteorder == "big":
+        data = array("H", data)
+        data.byteswap()
+    return data.tobytes()
+
+
+class ShmBridge:
+    """Host side of the shared region: one slot per emulated instance, written without syscalls."""
+
+    def __init__(self, path, timeout=5.0):
+        # The app (re)creates the file at boot and writes the magic last
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                fd = os.open(path, os.O_RDWR)
+                size = os.fstat(fd).st_size
+                if size >= HEADER.size:
+                    mm = mmap.mmap(fd, size)
+                    os.close(fd)
+                    if HEADER.unpack_from(mm)[0] == MAGIC:
+                        break
+                    mm.close()
+                else:
+                    os.close(fd)
+            except FileNotFoundError:
+                pass
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"{path} was not initialised by a running app")
+            time.sleep(0.05)
+
+        _, version, self.slots, self.capacity, self.slot_size = HEADER.unpack_from(mm)
+        if version != VERSION:
+            mm.close()
+            raise ValueError(f"{path}: layout version {version}, expected {VERSION}")
+        self.path = path
+        self.mm = mm
+        self.heads = {}
+
+    def _slot(self, instance):
+        if not 0 <= instance < self.slots:
+            raise IndexError(f"instance {instance} out of range (0..{self.slots - 1})")
+        return HEADER.size + instance * self.slot_size
+
+    def _field(self, instance, index, value=None):
+        offset = self._slot(instance) + 4 * index
+        if value is None:
+            return struct.unpack_from("<I", self.mm, offset)[0]
+        struct.pack_into("<I", self.mm, offset, value & 0xFFFFFFFF)
+
+    def _write_wave(self, instance, start, data):
+        offset = self._slot(instance) + SLOT.size + 2 * start
+        self.mm[offset:offset + len(data)] = data
+
+    def set_value(self, instance, raw):
+        offset = self._slot(instance)
+        struct.pack_into("<H", self.mm, offset + 16, raw & 0xFFFF)
+        self._field(instance, 0, MODE_VALUE)  # mode last: the value is in place before it is used
+
+    def loop(self, instance, samples):
+        data = as_samples(samples)
+        n = len(data) // 2
+        if not 0 < n <= self.capacity:
+            raise ValueError(f"waveform of {n} samples, the slot holds 1..{self.capacity}")
+        self._field(instance, 0, MODE_OFF)
+        self._write_wave(instance, 0, data)
+        self._field(instance, 1, n)
+        self._field(instance, 0, MODE_LOOP)
+
+    def push(self, instance, samples, timeout=None):
+        # Append to the instance's ring; blocks while it is full, returns how many samples were queued
+        data = as_samples(samples)
+        if self._field(instance, 0) != MODE_STREAM:
+            self._field(instance, 0, MODE_OFF)
+            self.heads[instance] = self._field(instance, 3)  # start empty: head = tail
+            self._field(instance, 2, self.heads[instance])
+            self._field(instance, 0, MODE_STREAM)
+        head = self.heads.setdefault(instance, self._field(instance, 2))
+        deadline = None if timeout is None else time.monotonic() + timeout
+        sent, total = 0, len(data) // 2
+        while sent < total:
+            free = self.capacity - ((head - self._field(instance, 3)) & 0xFFFFFFFF)
+            if free == 0:
+                if deadline is not None and time.monotonic() > deadline:
+                    break
+                time.sleep(0.001)
+                continue
+            n = min(free, total - sent)
+            start = head % self.capacity
+            first = min(n, self.capacity - start)
+            self._write_wave(instance, start, data[2 * sent:2 * (sent + first)])
+            if n > first:
+                self._write_wave(instance, 0, data[2 * (sent + first):2 * (sent + n)])
+            head = (head + n) & 0xFFFFFFFF
+            self._field(instance, 2, head)  # publish after the samples
+            sent += n
+        self.heads[instance] = head
+        return sent
+
+    def off(self, instance):
+        self._field(instance, 0, MODE_OFF)
+        self.heads.pop(instance, None)
+
+    def status(self, instance):
+        mode, length, head, tail, value, _ = SLOT.unpack_from(self.mm, self._slot(instance))
+        return {"mode": MODE_NAMES.get(mode, str(mode)), "len": length, "head": head, "tail": tail, "value": value,
+                "queued": (head - tail) & 0xFFFFFFFF if mode == MODE_STREAM else 0}
+
+    def close(self):
+        self.mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inject values into a running native_sim emulator generated with --shm.")
+    parser.add_argument("-m", "--module_name", required=True, help="Driver name, e.g. rohm_bh1750_emul")
+    parser.add_argument("-p", "--path", default=None, help="Shared file (default /dev/shm/<module_name>, CONFIG_<DRIVER>_SHM_PATH)")
+    parser.add_argument("-i", "--instance", type=int, default=None, help="Instance to drive (default all)")
+    parser.add_argument("--set", dest="value", type=lambda v: int(v, 0), default=None, help="Hold a raw value, e.g. 0x1234")
+    parser.add_argument("--loop", default=None, help="Repeat a CSV / .bin (uint16 LE) waveform, one sample per fetch")
+    parser.add_argument("--stream", default=None, help="Queue a CSV / .bin capture once, waiting while the ring is full")
+    parser.add_argument("--trace-column", type=int, default=0, help="CSV column holding the raw samples (default 0)")
+    parser.add_argument("--off", action="store_true", help="Stop injecting, the emulator goes back to its own values")
+    parser.add_argument("-t", "--timeout", type=float, default=5.0, help="Seconds to wait for the app to map the region (default 5)")
+
+    args = parser.parse_args()
+
+    samples = None
+    if args.loop or args.stream:
+        from zephyr_driver_emul import load_trace
+        samples = load_trace(args.loop or args.stream, args.trace_column)
+
+    with ShmBridge(args.path or f"/dev/shm/{args.module_name}", args.timeout) as bridge:
+        instances = [args.instance] if args.instance is not None else range(bridge.slots)
+        for inst in instances:
+            if args.off:
+                bridge.off(inst)
+            elif args.value is not None:
+                bridge.set_value(inst, args.value)
+            elif args.loop:
+                bridge.loop(inst, samples)
+            elif args.stream:
+                bridge.push(inst, samples)
+            print(f"{args.module_name}[{inst}]: " + ", ".join(f"{k}={v}" for k, v in bridge.status(inst).items()))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+import os
+import re
+import difflib
+import argparse
+import subprocess
+
+from zephyr_fs import Change, DiskFS, MemoryFS
+
+# Thread analyzer line, e.g. " led_thread          : STACK: unused 560 usage 464 / 1024 (45 %); CPU: 0 %"
+ANALYZER_RE = re.compile(r"(\S+)\s*:\s*STACK: unused (\d+) usage (\d+) / (\d+)")
+ANSI_RE = re.compile(r"\x1b\[[0-9;]*m")
+STACK_DEFINE_RE = re.compile(r"^(#define\s+(\w+)_STACK_SIZE\s+)(\w+)(.*)$", re.M)
+
+# Kernel threads whose stack is set from Kconfig instead of main.c
+KCONFIG_STACKS = {
+    "main": "CONFIG_MAIN_STACK_SIZE",
+    "logging": "CONFIG_LOG_PROCESS_THREAD_STACK_SIZE",
+    "sysworkq": "CONFIG_SYSTEM_WORKQUEUE_STACK_SIZE",
+}
+
+
+def parse_usage(text):
+    # Peak usage per thread over every analyzer report in the log
+    usage = {}
+    for line in ANSI_RE.sub("", text).splitlines():
+        m = ANALYZER_RE.search(line)
+        if not m:
+            continue
+        thread, used, size = m.group(1), int(m.group(3)), int(m.group(4))
+        peak, _ = usage.get(thread, (0, size))
+        usage[thread] = (max(peak, used), size)
+    return usage
+
+def run_app(build_dir, seconds):
+    # native_sim stops itself; other emulated boards are stopped after the timeout
+    exe = os.path.join(build_dir, "zephyr", "zephyr.exe")
+    if os.path.isfile(exe):
+        # POSIX arch threads execute on host pthread stacks, so these peaks understate real targets
+        print("Warning: native_sim stack usage is not representative, prefer a qemu board or a hardware log (-l)")
+        cmd = [exe, f"-stop_at={seconds}"]
+        timeout = None
+    else:
+        cmd = ["cmake", "--build", build_dir, "--target", "run"]
+        timeout = seconds
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, start_new_session=True)
+    try:
+        out, _ = proc.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        os.killpg(proc.pid, 15)
+        out, _ = proc.communicate()
+    return out.decode("utf-8", "replace")
+
+def thread_define(thread):
+    # 'led_thread' -> 'LED', 'rohm_bh1750_emul_thread' -> 'ROHM_BH1750_EMUL'
+    return re.sub(r"_thread$", "", thread).upper()
+
+def tuned_size(peak, margin=25, align=64, minimum=512):
+    size = peak * (100 + margin) // 100
+    size = -(-size // align) * align
+    return max(minimum, size)
+
+def resolve(value, defines):
+    seen = set()
+    while not value.isdigit() and value in defines and value not in seen:
+        seen.add(value)
+        value = defines[value]
+    return int(value) if value.isdigit() else None
+
+def tune_main_c(usage, path="src/main.c", *, fs=None, margin=25, align=64, minimum=512, show_diff=False):
+    fs = fs or DiskFS()
+    if not fs.isfile(path):
+        return [Change(path, "error", f"Error: {path} does not exist.")]
+
+    original = fs.read(path)
+    defines = dict(re.findall(r"^#define\s+(\w+)\s+(\w+)", original, re.M))
+    targets = {thread_define(thread): (thread, peak) for thread, (peak, _) in usage.items()}
+
+    changes = []
+    before = after = 0
+
+    def rewrite(m):
+        nonlocal before, after
+        old = resolve(m.group(3), defines)
+        if m.group(2) not in targets:
+            if old is not None:
+                before += old
+                after += old
+            return m.group(0)
+        thread, peak = targets.pop(m.group(2))
+        new = tuned_size(peak, margin, align, minimum)
+        before += old or 0
+        after += new
+        if new != old:
+            changes.append(Change(path, "updated", f"{thread}: peak {peak} B -> {m.group(2)}_STACK_SIZE {new} (was {old})"))
+        return f"{m.group(1)}{new}{m.group(4)}"
+
+    updated = STACK_DEFINE_RE.sub(rewrite, original)
+
+    for define, (thread, peak) in sorted(targets.items(), key=lambda kv: kv[1][0]):
+        if thread in KCONFIG_STACKS:
+            hint = f"set {KCONFIG_STACKS[thread]}={tuned_size(peak, margin, align, minimum)} in prj.conf"
+            changes.append(Change(path, "skipped", f"{thread}: peak {peak} B, {hint}"))
+        else:
+            changes.append(Change(path, "skipped", f"{thread}: peak {peak} B, no {define}_STACK_SIZE in {path}"))
+
+    if updated == original:
+        return changes + [Change(path, "unchanged", f"No change: {path}")]
+
+    diff = ""
+    if show_diff:
+        diff = "".join(difflib.unified_diff(
+            original.splitlines(True), updated.splitlines(True),
+            fromfile=f"{path} (old)", tofile=f"{path} (new)",
+        ))
+    fs.write(path, updated)
+    changes.append(Change(path, "updated", f"Updated: {path} (thread stacks {before} -> {after} bytes)", diff))
+    return changes
+
+def main():
+    parser = argparse.ArgumentParser(description="Resize per-thread stacks in main.c from thread analyzer peak usage.")
+    parser.add_argument("-b", "--build_dir", default="build-stack", help="Build with the thread analyzer enabled (default build-stack)")
+    parser.add_argument("-l", "--log", default=None, help="Parse an existing console log instead of running the app")
+    parser.add_argument("-t", "--seconds", type=int, default=10, help="How long to run the app (default 10)")
+    parser.add_argument("-m", "--margin", type=int, default=25, help="Safety margin over peak usage, in percent (default 25)")
+    parser.add_argument("--align", type=int, default=64, help="Round sizes up to this many bytes (default 64)")
+    parser.add_argument("--min", dest="minimum", type=int, default=512, help="Smallest stack size to write (default 512)")
+    parser.add_argument("-f", "--file", default="src/main.c", help="Source file holding the <NAME>_STACK_SIZE defines")
+    parser.add_argument("-n", "--dry-run", action="store_true", help="Print the diff without writing main.c")
+
+    args = parser.parse_args()
+
+    if args.log:
+        with open(args.log, "r", encoding="utf-8", errors="replace") as f:
+            text = f.read()
+    else:
+        text = run_app(args.build_dir, args.seconds)
+
+    usage = parse_usage(text)
+    if not usage:
+        print("Error: no thread analyzer output found (is CONFIG_THREAD_ANALYZER_USE_LOG enabled?)")
+        raise SystemExit(1)
+
+    fs = DiskFS()
+    if args.dry_run:
+        fs = MemoryFS({args.file: fs.read(args.file)})
+
+    for change in tune_main_c(usage, args.file, fs=fs, margin=args.margin, align=args.align,
+                              minimum=args.minimum, show_diff=args.dry_run):
+        print(change)
+        if change.diff:
+            print(change.diff)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+import os
+import re
+import sys
+import tty
+import time
+import select
+import shutil
+import argparse
+import threading
+import subprocess
+
+try:
+    import numpy as np
+except ImportError:
+    sys.exit("numpy is required to decode telemetry (pip install numpy).")
+
+# Frame written by telemetry_send() in the generated src/telemetry.c (little endian, packed)
+FRAME = np.dtype([
+    ("sync", "<u2"), ("ts_us", "<u4"), ("module", "u1"), ("instance", "u1"),
+    ("channel", "u1"), ("value", "<i4"), ("check", "u1"),
+])
+FRAME_SIZE = FRAME.itemsize
+SYNC0, SYNC1 = 0xA5, 0x5A
+
+# Decoded samples: timestamp unwrapped past the 32-bit microsecond counter, value in sensor units
+SAMPLE = np.dtype([
+    ("ts_us", "<i8"), ("module", "u1"), ("instance", "u1"), ("channel", "u1"), ("value", "<f8"),
+])
+
+TELEMETRY_ID_RE = re.compile(r"^#define\s+(\w+)_TELEMETRY_ID\s+(\d+)", re.M)
+# native_sim prints e.g. "uart_1 connected to pseudotty: /dev/pts/5"
+PTY_RE = re.compile(r"(\w+) connected to pseudotty: (\S+)")
+
+
+def decode(buf):
+    # Frames found in buf, and how many bytes were used up; the rest may be a partial frame
+    raw = np.frombuffer(buf, dtype=np.uint8)
+    n = len(raw) - FRAME_SIZE + 1
+    if n <= 0:
+        return np.empty(0, FRAME), 0
+    starts = np.flatnonzero((raw[:n] == SYNC0) & (raw[1:n + 1] == SYNC1))
+    rows = raw[starts[:, None] + np.arange(FRAME_SIZE)]
+    ok = np.bitwise_xor.reduce(rows[:, 2:-1], axis=1) == rows[:, -1]
+    starts, rows = starts[ok], rows[ok]
+    # A sync pattern inside a payload may pass the checksum by chance: drop frames overlapping an earlier one
+    if len(starts) > 1 and (np.diff(starts) < FRAME_SIZE).any():
+        keep, end = [], -1
+        for k, start in enumerate(starts):
+            if start >= end:
+                keep.append(k)
+                end = start + FRAME_SIZE
+        starts, rows = starts[keep], rows[keep]
+    consumed = max(n, int(starts[-1]) + FRAME_SIZE if len(starts) else 0)
+    return rows.view(FRAME).reshape(-1), consumed
+
+def read_frames(fd, alive=lambda: False, chunk=1 << 20):
+    # Bulk reads until EOF (or the pty closes); returns frames, skipped bytes and decode time
+    parts, carry, skipped, decode_s = [], b"", 0, 0.0
+    while True:
+        ready, _, _ = select.select([fd], [], [], 0.2)
+        if not ready:
+            if alive():
+                continue
+            break
+        try:
+            data = os.read(fd, chunk)
+        except OSError:
+            break  # EIO once the app closes its side of the pty
+        if not data:
+            break
+        buf = carry + data
+        start = time.perf_counter()
+        frames, consumed = decode(buf)
+        decode_s += time.perf_counter() - start
+        parts.append(frames)
+        skipped += consumed - len(frames) * FRAME_SIZE
+        carry = buf[consumed:]
+    frames = np.concatenate(parts) if parts else np.empty(0, FRAME)
+    return frames, skipped + len(carry), decode_s
+
+def to_samples(frames):
+    samples = np.empty(len(frames), SAMPLE)
+    ts = frames["ts_us"].astype(np.int64)
+    # Frames are timestamped under the sender lock, so a step back is a counter wrap
+    ts += np.cumsum(np.diff(ts, prepend=ts[:1]) < 0) << 32
+    samples["ts_us"] = ts
+    for field in ("module", "instance", "channel"):
+        samples[field] = frames[field]
+    samples["value"] = frames["value"] / 1000.0
+    return samples
+
+def module_names(path):
+    # Module byte -> driver name from the <NAME>_TELEMETRY_ID defines update_main_c writes
+    if not path or not os.path.isfile(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return {int(i): name.lower() for name, i in TELEMETRY_ID_RE.findall(f.read())}
+
+def format_report(samples, names, skipped, decode_s):
+    n = len(samples)
+    rate = f"{n / decode_s / 1e6:.1f} M frames/s" if decode_s > 0 else "-"
+    lines = [f"Decoded {n} frames in {decode_s * 1000:.1f} ms ({rate}), {skipped} bytes skipped"]
+    if not n:
+        return "\n".join(lines)
+    duration = max(1, int(samples["ts_us"][-1] - samples["ts_us"][0])) / 1e6
+    lines += [f"Stream duration: {duration:.3f} s", ""]
+    lines.append(f"{'module':<28} {'inst':>4} {'chan':>4} {'samples':>9} {'rate/s':>9} {'min':>10} {'mean':>10} {'max':>10}")
+    keys = (samples["module"].astype(np.uint32) << 16) | (samples["instance"].astype(np.uint32) << 8) | samples["channel"]
+    for key in np.unique(keys):
+        values = samples["value"][keys == key]
+        module = int(key >> 16)
+        lines.append(f"{names.get(module, str(module)):<28} {int(key >> 8) & 0xFF:>4} {int(key) & 0xFF:>4} {len(values):>9} "
+                     f"{len(values) / duration:>9.1f} {values.min():>10.3f} {values.mean():>10.3f} {values.max():>10.3f}")
+    return "\n".join(lines)
+
+def open_source(path):
+    fd = os.open(path, os.O_RDONLY | os.O_NOCTTY)
+    if os.isatty(fd):
+        tty.setraw(fd)  # no line discipline: 0x0d/0x0a and friends are payload bytes
+    return fd
+
+def run_app(exe, seconds, uart, verbose=False):
+    # Start native_sim and attach to the pseudotty it opens for the telemetry UART
+    proc = subprocess.Popen([exe, f"-stop_at={seconds}"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    console = sys.stdout.buffer if verbose else open(os.devnull, "wb")
+    for line in proc.stdout:
+        if verbose:
+            console.write(line)
+        m = PTY_RE.search(line.decode("utf-8", "replace"))
+        if m and m.group(1).lower().replace("_", "") == uart.lower().replace("_", ""):
+            break
+    else:
+        proc.wait()
+        sys.exit(f"Error: {exe} did not report a pseudotty for {uart}")
+    fd = open_source(m.group(2))
+    # Keep draining the console so the app never blocks on a full pipe
+    threading.Thread(target=shutil.copyfileobj, args=(proc.stdout, console), daemon=True).start()
+    return proc, fd
+
+def main():
+    parser = argparse.ArgumentParser(description="Decode the binary telemetry stream of a generated app into NumPy arrays.")
+    parser.add_argument("source", nargs="?", default=None, help="Capture file or serial/pty device to read")
+    parser.add_argument("--run", default=None, help="native_sim executable to start and read from (e.g. build/zephyr/zephyr.exe)")
+    parser.add_argument("-t", "--seconds", type=int, default=10, help="How long to run the app with --run (default 10)")
+    parser.add_argument("-u", "--uart", default="uart1", help="UART carrying the frames with --run (default uart1)")
+    parser.add_argument("-n", "--names", default="src/main.c", help="main.c holding the <NAME>_TELEMETRY_ID defines (default src/main.c)")
+    parser.add_argument("-o", "--output", default=None, help="Save the decoded samples as a structured .npy array")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Echo the app console with --run")
+
+    args = parser.parse_args()
+    if bool(args.source) == bool(args.run):
+        parser.error("give either a source or --run")
+
+    if args.run:
+        proc, fd = run_app(args.run, args.seconds, args.uart, args.verbose)
+        frames, skipped, decode_s = read_frames(fd, alive=lambda: proc.poll() is None)
+        proc.wait()
+    else:
+        fd = open_source(args.source)
+        frames, skipped, decode_s = read_frames(fd)
+    os.close(fd)
+
+    samples = to_samples(frames)
+    if args.output:
+        np.save(args.output, samples)
+    print(format_report(samples, module_names(args.names), skipped, decode_s))
+
+if __name__ == "__main__":
+    main()
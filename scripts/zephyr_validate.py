@@ -0,0 +1,207 @@
+import os
+import re
+import sys
+import time
+import argparse
+
+from zephyr_fs import Change, DiskFS
+
+# [ \t] and not \s: an empty "VAR ?=" must not run on into the next line
+MAKE_VAR_RE = re.compile(r"^(\w+)[ \t]*\?=[ \t]*(.*?)[ \t]*$", re.M)
+EXTRA_MODULES_RE = re.compile(r"set\(\s*ZEPHYR_EXTRA_MODULES(.*?)\)", re.S)
+COMMENT_RE = re.compile(r"/\*.*?\*/|//[^\n]*", re.S)
+DTS_TOKEN_RE = re.compile(r"([^{};]*)([{};])")
+NODE_HEADER_RE = re.compile(r"^((?:\w+\s*:\s*)*)(&?[\w,./+-]+?)(?:@(\w+))?$")
+BINDING_COMPAT_RE = re.compile(r"^compatible:\s*\"([^\"]+)\"", re.M)
+KCONFIG_RE = re.compile(r"^\s*(?:menu)?config\s+(\w+)", re.M)
+PRJ_CONF_RE = re.compile(r"^CONFIG_(\w+)=(.*)$", re.M)
+DRV_COMPAT_RE = re.compile(r"^\s*#define\s+DT_DRV_COMPAT\s+(\w+)", re.M)
+NODELABEL_RE = re.compile(r"DT_NODELABEL\(\s*(\w+)\s*\)")
+FOREACH_OKAY_RE = re.compile(r"DT_FOREACH_STATUS_OKAY\(\s*(\w+)\s*,")
+TRIGGER_SET_RE = re.compile(r"sensor_trigger_set\(\s*(\w+)_devs\[")
+
+
+def normalize(compat):
+    # Devicetree macros spell a compatible lowercase with every other character as '_'
+    return re.sub(r"[^a-z0-9]", "_", compat.lower())
+
+def line_of(text, pos):
+    return text.count("\n", 0, pos) + 1
+
+def parse_overlay(text):
+    # Flat list of nodes: labels, name, unit address, properties, parent index, line
+    text = COMMENT_RE.sub(lambda m: "\n" * m.group(0).count("\n"), text)
+    nodes, stack = [], []
+    for m in DTS_TOKEN_RE.finditer(text):
+        head, token = m.group(1).strip(), m.group(2)
+        if token == "{":
+            header = NODE_HEADER_RE.match(head)
+            indent = len(m.group(1)) - len(m.group(1).lstrip())
+            nodes.append({
+                "labels": re.findall(r"(\w+)\s*:", header.group(1)) if header else [],
+                "name": header.group(2) if header else head,
+                "addr": header.group(3) if header else None,
+                "props": {},
+                "parent": stack[-1] if stack else None,
+                "line": line_of(text, m.start(1) + indent),
+            })
+            stack.append(len(nodes) - 1)
+        elif token == "}":
+            if stack:
+                stack.pop()
+        elif head and stack:
+            key, _, value = head.partition("=")
+            nodes[stack[-1]]["props"][key.strip()] = value.strip()
+    return nodes
+
+def strings(value):
+    return re.findall(r"\"([^\"]*)\"", value)
+
+def first_cell(value):
+    m = re.search(r"<\s*(\w+)", value)
+    return int(m.group(1), 0) if m else None
+
+def extra_modules(fs):
+    if not fs.isfile("CMakeLists.txt"):
+        return []
+    m = EXTRA_MODULES_RE.search(fs.read("CMakeLists.txt"))
+    if not m:
+        return []
+    return [p.replace("${CMAKE_SOURCE_DIR}/", "").replace("${CMAKE_SOURCE_DIR}", ".") for p in strings(m.group(1))]
+
+def index_project(fs, overlay):
+    # One pass over everything the checks need
+    index = {"bindings": [], "kconfig": {}, "compats": [], "modules": [], "sources": []}
+    for module in extra_modules(fs):
+        files = fs.list_files(module)
+        index["modules"].append((module, files))
+        for path in files:
+            if path.endswith(".yaml") and f"{os.sep}bindings{os.sep}" in path:
+                content = fs.read(path)
+                m = BINDING_COMPAT_RE.search(content)
+                if m:
+                    index["bindings"].append((path, line_of(content, m.start()), m.group(1)))
+            elif os.path.basename(path).startswith("Kconfig"):
+                for symbol in KCONFIG_RE.findall(fs.read(path)):
+                    index["kconfig"][symbol] = path
+            elif path.endswith(".c"):
+                content = fs.read(path)
+                for m in DRV_COMPAT_RE.finditer(content):
+                    index["compats"].append((path, line_of(content, m.start(1)), m.group(1)))
+    for path in fs.list_files("src"):
+        if path.endswith((".c", ".h")):
+            index["sources"].append((path, fs.read(path)))
+    overlay_text = fs.read(overlay) if fs.isfile(overlay) else ""
+    index["nodes"] = parse_overlay(overlay_text)
+    prj_text = fs.read("prj.conf") if fs.isfile("prj.conf") else ""
+    index["prj"] = {m.group(1): (m.group(2), line_of(prj_text, m.start())) for m in PRJ_CONF_RE.finditer(prj_text)}
+    return index
+
+def validate(project_dir=".", overlay=None, fs=None):
+    fs = fs or DiskFS(project_dir)
+    if overlay is None:
+        manifest = dict(MAKE_VAR_RE.findall(fs.read("Makefile"))) if fs.isfile("Makefile") else {}
+        overlay = f"boards/{manifest.get('OVERLAY', 'native_sim')}.overlay"
+    if not fs.isfile(overlay):
+        return [Change(overlay, "error", f"Error: {overlay} does not exist.")]
+
+    index = index_project(fs, overlay)
+    nodes = index["nodes"]
+    issues = []
+
+    def error(path, line, message):
+        issues.append(Change(path, "error", f"{path}:{line}: error: {message}"))
+
+    def warning(path, line, message):
+        issues.append(Change(path, "warning", f"{path}:{line}: warning: {message}"))
+
+    # Modules listed in ZEPHYR_EXTRA_MODULES must exist and be Zephyr modules
+    for module, files in index["modules"]:
+        if os.path.join(module, "zephyr", "module.yaml") not in [os.path.normpath(f) for f in files]:
+            error("CMakeLists.txt", 1, f"ZEPHYR_EXTRA_MODULES entry '{module}' has no zephyr/module.yaml")
+
+    # Binding compatible vs binding filename
+    binding_compats = {}
+    for path, line, compat in index["bindings"]:
+        binding_compats[normalize(compat)] = compat
+        stem = os.path.basename(path)[:-len(".yaml")]
+        if compat != stem:
+            error(path, line, f"compatible \"{compat}\" does not match file name '{stem}.yaml'")
+
+    okay = {i for i, n in enumerate(nodes) if "compatible" in n["props"] and strings(n["props"].get("status", '"okay"')) != ["disabled"]}
+    node_compats = {normalize(c) for i in okay for c in strings(nodes[i]["props"]["compatible"])}
+
+    # DT_DRV_COMPAT vs bindings and overlay nodes
+    for path, line, drv_compat in index["compats"]:
+        if drv_compat not in binding_compats:
+            error(path, line, f"DT_DRV_COMPAT {drv_compat} has no binding in the extra modules "
+                              f"(known: {', '.join(sorted(binding_compats.values())) or 'none'})")
+        elif drv_compat not in node_compats:
+            warning(path, line, f"no okay node in {overlay} has compatible \"{binding_compats[drv_compat]}\"")
+
+    # Overlay nodes: compatible known, unit address vs reg, duplicate bus addresses
+    drv_compats = {c for _, _, c in index["compats"]}
+    by_bus = {}
+    for i, node in enumerate(nodes):
+        for compat in strings(node["props"].get("compatible", "")):
+            # Upstream emulators are 'zephyr,...'; other '-emul' compatibles come from the generator
+            if compat.endswith("-emul") and not compat.startswith("zephyr,") and normalize(compat) not in (binding_compats.keys() | drv_compats):
+                error(overlay, node["line"], f"node '{node['name']}' uses compatible \"{compat}\" with no binding in the extra modules")
+        reg = first_cell(node["props"].get("reg", ""))
+        if reg is None:
+            continue
+        if node["addr"] and re.fullmatch(r"[0-9a-fA-F]+", node["addr"]) and int(node["addr"], 16) != reg:
+            warning(overlay, node["line"], f"unit address @{node['addr']} does not match reg <0x{reg:x}>")
+        if i in okay:
+            seen = by_bus.setdefault((node["parent"], reg), node)
+            if seen is not node:
+                bus = nodes[node["parent"]]["name"] if node["parent"] is not None else "/"
+                error(overlay, node["line"], f"address 0x{reg:x} on {bus} already used by '{seen['name']}' (line {seen['line']})")
+
+    # Labels referenced by the application
+    labels = {l for n in nodes for l in n["labels"]} | {n["name"][1:] for n in nodes if n["name"].startswith("&")}
+    for path, content in index["sources"]:
+        for m in NODELABEL_RE.finditer(content):
+            if m.group(1) not in labels:
+                error(path, line_of(content, m.start(1)), f"DT_NODELABEL({m.group(1)}) is not defined or referenced in {overlay}")
+        for m in FOREACH_OKAY_RE.finditer(content):
+            if m.group(1) in drv_compats and m.group(1) not in node_compats:
+                warning(path, line_of(content, m.start(1)), f"no okay {m.group(1)} node in {overlay}: {m.group(1)}_devs[] is empty")
+        for m in TRIGGER_SET_RE.finditer(content):
+            for i in sorted(okay):
+                compats = {normalize(c) for c in strings(nodes[i]["props"]["compatible"])}
+                if m.group(1) in compats and "int-gpios" not in nodes[i]["props"]:
+                    error(overlay, nodes[i]["line"], f"node '{nodes[i]['name']}' has no int-gpios but {path} sets a data-ready trigger on it")
+
+    # prj.conf vs Kconfig of the generated drivers
+    for drv_compat in sorted(drv_compats & node_compats):
+        symbol = drv_compat.upper()
+        if symbol in index["kconfig"] and index["prj"].get(symbol, ("n",))[0] != "y":
+            error("prj.conf", 1, f"CONFIG_{symbol}=y missing: the {drv_compat} nodes in {overlay} have no driver")
+    for symbol, (value, line) in index["prj"].items():
+        if value == "y" and symbol.lower() in node_compats and symbol not in index["kconfig"]:
+            error("prj.conf", line, f"CONFIG_{symbol} is not defined by any module in ZEPHYR_EXTRA_MODULES")
+
+    return issues
+
+def main():
+    parser = argparse.ArgumentParser(description="Check a generated Zephyr app for overlay/binding/Kconfig/source mismatches before building.")
+    parser.add_argument("-d", "--project_dir", default=".", help="Generated app directory (default current directory)")
+    parser.add_argument("-y", "--overlay", default=None, help="Overlay to check, relative to the app (default boards/$(OVERLAY).overlay from the Makefile)")
+    parser.add_argument("-W", "--werror", action="store_true", help="Treat warnings as errors")
+
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    issues = validate(args.project_dir, args.overlay)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+
+    for issue in issues:
+        print(issue)
+    errors = sum(1 for i in issues if i.action == "error" or (args.werror and i.action == "warning"))
+    warnings = sum(1 for i in issues if i.action == "warning")
+    print(f"Validated in {elapsed_ms:.1f} ms: {errors} error(s), {warnings} warning(s)")
+    sys.exit(1 if errors else 0)
+
+if __name__ == "__main__":
+    main()
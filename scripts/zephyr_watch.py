@@ -0,0 +1,193 @@
+import os
+import re
+import time
+import glob
+import shutil
+import argparse
+import subprocess
+
+from zephyr_fs import DiskFS
+from zephyr_driver_emul import add_driver, create_structure
+from zephyr_validate import MAKE_VAR_RE, validate
+
+DRIVER_KEYS = ("DRIVER", "ITF", "ADD")
+# Options forwarded to the generator (see apply): driver sources only, or the app files too
+SOURCE_OPTION_KEYS = ("TRACE", "CAL", "BUS_TIMING", "TRIGGER", "PM", "SHM")
+APP_OPTION_KEYS = ("AGGREGATE", "TELEMETRY", "REDUCE")
+# 'make config' configures this one and keeps its stamp (build/.config-stamp)
+MAKE_BUILD_DIR = "build"
+
+
+def read_manifest(fs, path="Makefile"):
+    if not fs.isfile(path):
+        return {}
+    return dict(MAKE_VAR_RE.findall(fs.read(path)))
+
+def snapshot(project_dir):
+    # mtimes of every file whose change can affect the generated app
+    paths = ["Makefile", "prj.conf", "CMakeLists.txt"]
+    paths += sorted(os.path.relpath(p, project_dir) for p in glob.glob(os.path.join(project_dir, "boards", "*.overlay")))
+    stamps = {}
+    for path in paths:
+        try:
+            stamps[path] = os.stat(os.path.join(project_dir, path)).st_mtime_ns
+        except FileNotFoundError:
+            pass
+    return stamps
+
+def retarget_overlay_node(fs, module_name, old_addr, new_addr, overlay_path="boards/native_sim.overlay"):
+    node_label = '_'.join(module_name.split('_')[:-1])
+    if not fs.isfile(overlay_path):
+        return False
+    content = fs.read(overlay_path)
+    updated = content.replace(f"{node_label}@{old_addr} {{", f"{node_label}@{new_addr} {{")
+    updated = re.sub(
+        rf"({re.escape(node_label)}@{re.escape(new_addr)} \{{.*?reg = <0x){re.escape(old_addr)}>",
+        rf"\g<1>{new_addr}>", updated, count=1, flags=re.S,
+    )
+    if updated == content:
+        return False
+    fs.write(overlay_path, updated)
+    return True
+
+def plan(old, new, old_stamps, new_stamps):
+    # Work out the smallest set of steps that covers what changed
+    steps = []
+    old_driver = tuple(old.get(k) for k in DRIVER_KEYS)
+    new_driver = tuple(new.get(k) for k in DRIVER_KEYS)
+    if old_driver != new_driver and all(new_driver):
+        if old_driver[0] != new_driver[0]:
+            steps.append("add-driver")
+        else:
+            if old_driver[1] != new_driver[1]:
+                steps.append("restructure")
+            if old_driver[2] != new_driver[2]:
+                steps.append("retarget")
+    if all(new_driver) and "add-driver" not in steps:
+        if any(old.get(k) != new.get(k) for k in APP_OPTION_KEYS):
+            steps.append("add-driver")
+        elif "restructure" not in steps and any(old.get(k) != new.get(k) for k in SOURCE_OPTION_KEYS):
+            steps.append("restructure")
+    if old.get("BOARD") != new.get("BOARD"):
+        steps.append("pristine")
+    elif any(old.get(k) != new.get(k) for k in ("OVERLAY", "PCH")):
+        steps.append("configure")
+    if steps or old_stamps != new_stamps:
+        steps.append("build")
+    return steps
+
+def configure(project_dir, manifest, build_dir, pristine=False):
+    build_path = os.path.join(project_dir, build_dir)
+    # A build dir configured with another generator cannot be switched to Ninja in place
+    if os.path.isfile(os.path.join(build_path, "CMakeCache.txt")) and not os.path.isfile(os.path.join(build_path, "build.ninja")):
+        pristine = True
+    if pristine and os.path.isdir(build_path):
+        shutil.rmtree(build_path)
+    if build_dir == MAKE_BUILD_DIR:
+        # Same CMake call and stamp as the Makefile, so a later 'make build' does not reconfigure again
+        return subprocess.run(["make", "config"], cwd=project_dir).returncode == 0
+    cmd = ["cmake", "-G", "Ninja", "-S", ".", "-B", build_dir,
+           f"-DBOARD={manifest.get('BOARD', 'native_sim')}",
+           f"-DDTC_OVERLAY_FILE=boards/{manifest.get('OVERLAY', 'native_sim')}.overlay",
+           # As EMUL_BUILD_OPTS in the Makefile
+           f"-DEMUL_PCH={'ON' if manifest.get('PCH') else 'OFF'}"]
+    return subprocess.run(cmd, cwd=project_dir).returncode == 0
+
+def build(project_dir, build_dir):
+    return subprocess.run(["cmake", "--build", build_dir], cwd=project_dir).returncode == 0
+
+def start_run(project_dir, build_dir):
+    return subprocess.Popen(["cmake", "--build", build_dir, "--target", "run"], cwd=project_dir)
+
+def stop_run(proc):
+    if proc is not None and proc.poll() is None:
+        proc.terminate()
+        try:
+            proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+def apply(steps, fs, old, new, output):
+    options = dict(aggregate=new.get("AGGREGATE") or None, trigger=bool(new.get("TRIGGER")), pm=bool(new.get("PM")),
+                   shm=bool(new.get("SHM")), trace=new.get("TRACE") or None,
+                   calibration=new.get("CAL") or None, bus_timing=bool(new.get("BUS_TIMING")))
+    # App side only, create_structure does not take them
+    app_options = dict(telemetry=bool(new.get("TELEMETRY")), reduce=new.get("REDUCE") or None)
+    for step in steps:
+        if step == "add-driver":
+            changes = add_driver(new["DRIVER"], new["ITF"], new["ADD"], output=output, fs=fs, **app_options, **options)
+        elif step == "restructure":
+            changes = create_structure(output, new["DRIVER"], new["ITF"], "sensor", fs=fs, **options)
+        elif step == "retarget":
+            if not old.get("ADD") or not retarget_overlay_node(fs, new["DRIVER"], old["ADD"], new["ADD"]):
+                changes = add_driver(new["DRIVER"], new["ITF"], new["ADD"], output=output, fs=fs, **app_options, **options)
+            else:
+                changes = []
+                print(f"Moved {new['DRIVER']} from 0x{old['ADD']} to 0x{new['ADD']}")
+        else:
+            continue
+        for change in changes:
+            print(change)
+
+def watch(project_dir=".", output="../modules", build_dir="build", interval=0.5, run=True):
+    fs = DiskFS(project_dir)
+    manifest = read_manifest(fs)
+    stamps = snapshot(project_dir)
+    proc = None
+
+    # 'make config' is a no-op while its stamp matches
+    if build_dir == MAKE_BUILD_DIR or not os.path.isdir(os.path.join(project_dir, build_dir)):
+        configure(project_dir, manifest, build_dir)
+    if build(project_dir, build_dir) and run:
+        proc = start_run(project_dir, build_dir)
+
+    print(f"Watching {os.path.abspath(project_dir)} (Ctrl+C to stop)")
+    try:
+        while True:
+            time.sleep(interval)
+            new_stamps = snapshot(project_dir)
+            if new_stamps == stamps:
+                continue
+            new_manifest = read_manifest(fs)
+            steps = plan(manifest, new_manifest, stamps, new_stamps)
+            print(f"Change detected -> {', '.join(steps)}")
+
+            stop_run(proc)
+            proc = None
+            apply(steps, fs, manifest, new_manifest, output)
+
+            # Catch generator/overlay mismatches before spending time in CMake
+            issues = validate(fs=fs)
+            for issue in issues:
+                print(issue)
+            ok = not any(issue.action == "error" for issue in issues)
+            if ok and "pristine" in steps:
+                ok = configure(project_dir, new_manifest, build_dir, pristine=True)
+            elif ok and "configure" in steps:
+                ok = configure(project_dir, new_manifest, build_dir)
+            if ok and build(project_dir, build_dir) and run:
+                proc = start_run(project_dir, build_dir)
+
+            manifest = new_manifest
+            # Our own regeneration touches watched files: take the stamps after it
+            stamps = snapshot(project_dir)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_run(proc)
+
+def main():
+    parser = argparse.ArgumentParser(description="Watch a generated Zephyr app and regenerate/rebuild on change.")
+    parser.add_argument("-d", "--project_dir", default=".", help="Generated app directory (default current directory)")
+    parser.add_argument("-o", "--output", default="../modules", help="Driver modules directory, relative to the app (default ../modules)")
+    parser.add_argument("-b", "--build_dir", default="build", help="Build directory (default build)")
+    parser.add_argument("-t", "--interval", type=float, default=0.5, help="Polling interval in seconds (default 0.5)")
+    parser.add_argument("--no-run", action="store_true", help="Only rebuild, do not run the app")
+
+    args = parser.parse_args()
+
+    watch(args.project_dir, args.output, args.build_dir, args.interval, run=not args.no_run)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,21 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+
+from zephyr_fs import MemoryFS
+from zephyr_env import generate_project
+from zephyr_watch import read_manifest
+
+
+def test_read_manifest_keeps_empty_options_empty():
+    fs = MemoryFS()
+    generate_project("blink", None, None, "app", "native_sim", "native_sim", fs=fs)
+    manifest = read_manifest(fs.at("app"))
+
+    for key in ("TRACE", "CAL", "BUS_TIMING", "TRIGGER", "PM", "TELEMETRY", "REDUCE", "SHM", "AGGREGATE",
+                "DRIVERS", "PCH"):
+        assert manifest[key] == "", key
+    assert manifest["DRIVER"] == "sensirion_sht3xd_emul"
+    assert manifest["ADD"] == "44"
+    assert manifest["BOARD"] == "native_sim"